@@ -0,0 +1,49 @@
+import mne
+import os
+import sys
+
+from store import write_store
+
+
+def build_store(processed_folder):
+    """
+    Writes the memory-mapped store of every processed run that does not have an up to date one yet,
+    for data that was processed before process_subject wrote it
+    ---
+    input:
+        folder with the processed subject folders
+    """
+
+    for subject_folder in sorted(os.listdir(processed_folder)):
+        if not subject_folder.startswith("subject"):
+            continue
+
+        for run_folder in sorted(os.listdir(os.path.join(processed_folder, subject_folder))):
+            folder = os.path.join(processed_folder, subject_folder, run_folder)
+            if not run_folder.startswith("run"):
+                continue
+
+            # Skip stores that are complete and newer than the run they were written from
+            store_paths = [
+                os.path.join(folder, file_name)
+                for file_name in ["processed.npy", "processed_store.json"]
+            ]
+            raw_path = os.path.join(folder, "processed.fif")
+            if all(
+                [
+                    os.path.exists(store_path)
+                    and os.path.getmtime(store_path) >= os.path.getmtime(raw_path)
+                    for store_path in store_paths
+                ]
+            ):
+                continue
+
+            raw = mne.io.read_raw_fif(raw_path)
+            raw.set_annotations(
+                mne.read_annotations(os.path.join(folder, "processed_annotations.fif"))
+            )
+            write_store(raw, folder)
+
+
+if __name__ == "__main__":
+    build_store(sys.argv[1] if len(sys.argv) > 1 else "data/processed")
@@ -3,13 +3,142 @@ import numpy
 import os
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+from scipy import spatial
 
-def build_metadata_file():
+# Folder with the processed subject folders, the metadata is written here too
+processed_folder = "/scratch/brussel/102/vsc10248/info-vis-data/processed"
+
+
+def mesh_faces(mesh_coords):
+    """
+    Triangulates a cap mesh once, so the browser does not have to
+    ---
+    input:
+        mesh coordinates (points x 3)
+    ---
+    output:
+        vertex indices of the triangles as [i, j, k]
+        (Delaunay triangulation of the positions projected on the x-y plane,
+        as Plotly computes when a mesh has no faces)
+    """
+    return spatial.Delaunay(mesh_coords[:, :2]).simplices.T.tolist()
+
+
+def save_metadata_arrays(subject_data, meg_faces, subject_faces, path):
+    """
+    Saves the metadata in a compact binary format (numpy arrays, groups as integer codes),
+    which the visualisation loads instead of the JSON file, together with the triangles of the cap meshes
+    ---
+    input:
+        metadata as written to the JSON file
+        triangles of the MEG cap mesh
+        dict of triangles of the EEG cap mesh per subject id
+        path of the .npz file
+    """
+
+    # Group names in order of first appearance, channels refer to them by index
+    group_names = list(dict.fromkeys(subject_data["eeg_types"] + subject_data["meg_types"]))
+    group_codes = {group_name: code for code, group_name in enumerate(group_names)}
+
+    subjects = subject_data["subjects"]
+    arrays = {
+        "group_names": numpy.array(group_names),
+        "meg_names": numpy.array(subject_data["meg_names"]),
+        "meg_group_codes": numpy.array(
+            [group_codes[meg_type] for meg_type in subject_data["meg_types"]], dtype=numpy.int8
+        ),
+        "eeg_names": numpy.array(subject_data["eeg_names"]),
+        "eeg_group_codes": numpy.array(
+            [group_codes[eeg_type] for eeg_type in subject_data["eeg_types"]], dtype=numpy.int8
+        ),
+        "meg_coords": numpy.array(subject_data["meg_coords"]),
+        "meg_mesh_coords": numpy.array(subject_data["meg_mesh_coords"]),
+        "meg_mesh_faces": numpy.array(meg_faces, dtype=numpy.int32),
+        "subject_ids": numpy.array([subject["id"] for subject in subjects]),
+        "subject_ages": numpy.array([int(subject["age"]) for subject in subjects]),
+        "subject_sexes": numpy.array([subject["sex"] for subject in subjects]),
+        "eeg_coords": numpy.array([subject["eeg_coords"] for subject in subjects]),
+        "mesh_coords": numpy.array([subject["mesh_coords"] for subject in subjects]),
+    }
+
+    # The number of triangles differs per subject
+    for subject in subjects:
+        arrays["mesh_faces_" + str(subject["id"])] = numpy.array(
+            subject_faces[subject["id"]], dtype=numpy.int32
+        )
+
+    numpy.savez(path, **arrays)
+
+
+def subject_sources(subject_id):
+    """
+    Returns the size and modification time of the files a subject's metadata is extracted from
+    """
+    sources = {}
+    for file_name in ["info.json", "run1/eeg_coords.npy"]:
+        stat = os.stat(os.path.join(processed_folder, "subject" + str(subject_id), file_name))
+        sources[file_name] = [stat.st_size, stat.st_mtime_ns]
+
+    return sources
+
+
+def subject_metadata(subject_id, previous):
+    """
+    Extracts the metadata of a subject, reusing the previous extraction if its files did not change
+    ---
+    input:
+        subject id
+        previous extraction of the subject (None if there is none)
+    ---
+    output:
+        dict with the metadata of the subject, the triangles of its cap mesh
+        and the files it was extracted from (see subject_sources)
+    """
+
+    sources = subject_sources(subject_id)
+    if previous is not None and previous["sources"] == sources:
+        return previous
 
-    # Read first run of first subject
-    raw = mne.io.read_raw_fif(
-        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject1/run1/processed.fif"
+    # Gather all subject specific info
+    with open(
+        os.path.join(processed_folder, "subject" + str(subject_id), "info.json"),
+        mode="rb",
+    ) as info_file:
+        subject_info = json.load(info_file)
+
+    eeg_coords = numpy.load(
+        os.path.join(processed_folder, "subject" + str(subject_id), "run1/eeg_coords.npy")
     )
+    mesh_coords = 0.95 * eeg_coords
+
+    eeg_x = eeg_coords[:, 0].tolist()
+    eeg_y = eeg_coords[:, 1].tolist()
+    eeg_z = eeg_coords[:, 2].tolist()
+
+    mesh_x = mesh_coords[:, 0].tolist()
+    mesh_y = mesh_coords[:, 1].tolist()
+    mesh_z = mesh_coords[:, 2].tolist()
+
+    return {
+        "subject": {
+            "id": subject_id,
+            "name": "subject " + str(subject_id),
+            "age": subject_info["age"],
+            "sex": "m" if subject_info["sex"] == 1 else "f",
+            # eeg coords can differ per subject
+            "eeg_coords": [eeg_x, eeg_y, eeg_z],
+            "mesh_coords": [mesh_x, mesh_y, mesh_z],
+        },
+        "mesh_faces": mesh_faces(mesh_coords),
+        "sources": sources,
+    }
+
+
+def build_metadata_file():
+
+    # Read the measurement info of the first run of the first subject (without its data)
+    info = mne.io.read_info(os.path.join(processed_folder, "subject1/run1/processed.fif"))
 
     # ----
     # MEG coords, names, and types
@@ -18,12 +147,12 @@ def build_metadata_file():
     # Extract and collect
     meg_coords = []
     meg_names = []
-    for channel_info in raw.info["chs"]:
+    for channel_info in info["chs"]:
         channel_name = channel_info["ch_name"]
         if "MEG" in channel_info["ch_name"]:
             meg_coords.append(
                 mne.transforms.apply_trans(
-                    raw.info["dev_head_t"], channel_info["loc"][:3]
+                    info["dev_head_t"], channel_info["loc"][:3]
                 )
             )
             meg_names.append(channel_name)
@@ -146,7 +275,7 @@ def build_metadata_file():
     # ----
     # EEG names and types
     # ----
-    eeg_names = [ch["ch_name"] for ch in raw.info["chs"] if "EEG" in ch["ch_name"]]
+    eeg_names = [ch["ch_name"] for ch in info["chs"] if "EEG" in ch["ch_name"]]
     eeg_types = [
         "Occipital lobe",  # EEG001
         "Frontal lobe",  # EEG002
@@ -235,64 +364,53 @@ def build_metadata_file():
         "meg_mesh_coords": [meg_mesh_x, meg_mesh_y, meg_mesh_z],
     }
 
-    # Initialize list of subjects
-    subjects = []
+    # Previously extracted subjects (kept next to the metadata), only new or changed subjects are extracted again
+    sources_path = os.path.join(processed_folder, "metadata_sources.json")
+    previous_subjects = {}
+    if os.path.exists(sources_path):
+        with open(sources_path) as infile:
+            previous_subjects = {
+                extraction["subject"]["id"]: extraction for extraction in json.load(infile)
+            }
 
-    # Go over each subject folder
-    for subject_id in sorted(
+    # Go over the subject folders concurrently
+    subject_ids = sorted(
         [
             int(subject_folder.removeprefix("subject"))
-            for subject_folder in os.listdir(
-                "/scratch/brussel/102/vsc10248/info-vis-data/processed"
-            )
+            for subject_folder in os.listdir(processed_folder)
+            if subject_folder.startswith("subject")
         ]
-    ):
-
-        # Gather all subject specific info
-        with open(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + str(subject_id)
-            + "/info.json",
-            mode="rb",
-        ) as info_file:
-            subject_info = json.load(info_file)
-
-            eeg_coords = numpy.load(
-                "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-                + str(subject_id)
-                + "/run1/eeg_coords.npy"
-            )
-            mesh_coords = 0.95 * eeg_coords
-
-            eeg_x = eeg_coords[:, 0].tolist()
-            eeg_y = eeg_coords[:, 1].tolist()
-            eeg_z = eeg_coords[:, 2].tolist()
-
-            mesh_x = mesh_coords[:, 0].tolist()
-            mesh_y = mesh_coords[:, 1].tolist()
-            mesh_z = mesh_coords[:, 2].tolist()
-
-            subjects.append(
-                {
-                    "id": subject_id,
-                    "name": "subject " + str(subject_id),
-                    "age": subject_info["age"],
-                    "sex": "m" if subject_info["sex"] == 1 else "f",
-                    # eeg coords can differ per subject
-                    "eeg_coords": [eeg_x, eeg_y, eeg_z],
-                    "mesh_coords": [mesh_x, mesh_y, mesh_z],
-                }
+    )
+    with ThreadPoolExecutor() as executor:
+        extractions = list(
+            executor.map(
+                lambda subject_id: subject_metadata(
+                    subject_id, previous_subjects.get(subject_id)
+                ),
+                subject_ids,
             )
+        )
 
     # Store the subject info
-    subject_data["subjects"] = subjects
+    subject_data["subjects"] = [extraction["subject"] for extraction in extractions]
 
     # Generate and save the JSON object with all metadata
     json_object = json.dumps(subject_data, indent=4)
-    with open(
-        "/scratch/brussel/102/vsc10248/info-vis-data/processed/metadata.json", "w"
-    ) as outfile:
+    with open(os.path.join(processed_folder, "metadata.json"), "w") as outfile:
         outfile.write(json_object)
+    save_metadata_arrays(
+        subject_data,
+        mesh_faces(meg_mesh),
+        {
+            extraction["subject"]["id"]: extraction["mesh_faces"]
+            for extraction in extractions
+        },
+        os.path.join(processed_folder, "metadata.npz"),
+    )
+
+    # Save what the subjects were extracted from, for the next run
+    with open(sources_path, "w") as outfile:
+        json.dump(extractions, outfile)
 
 
 if __name__ == "__main__":
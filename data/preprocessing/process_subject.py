@@ -1,132 +1,412 @@
 import mne
-import sys
 import os
+import sys
+import glob
 import json
 import numpy
+import hashlib
 import mne_bids
+import argparse
+import multiprocessing
+import threadpoolctl
 
+from store import write_store
 
-def process_subject(subject_id):
 
-    # Make subject folder
-    os.mkdir("/scratch/brussel/102/vsc10248/info-vis-data/processed/subject" + subject_id)
+# Pipeline parameters, runs are processed again when these change
+parameters = {
+    "l_freq": 1.0,
+    "h_freq": 70,
+    "notch_freq": 50,
+    "sfreq": 145,
+    "ica_components": 16,
+    "ica_random_state": 97,
+}
 
-    # Loop over runs
-    for run_id in range(1,7):
+# Files written for each run
+output_files = [
+    "eeg_coords.npy",
+    "ICA.pdf",
+    "processed.fif",
+    "processed_annotations.fif",
+    "processed.npy",
+    "processed_store.json",
+]
 
-        # Define path to files
-        bids_path = mne_bids.BIDSPath(subject=subject_id.zfill(2), session="meg", task="facerecognition", datatype="meg", run=run_id, root="/scratch/brussel/102/vsc10248/info-vis-data/raw")
 
-        # Read raw
-        raw = []
-        try:
-            raw = mne_bids.read_raw_bids(bids_path=bids_path)
-            raw.load_data()
-        except:
-            continue
+# ----
+# Manifest
+# ----
+def run_folder(subject_id, run_id):
+    return (
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
+        + subject_id
+        + "/run"
+        + str(run_id)
+    )
 
-        # Make folder for run
-        os.mkdir(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-        )
-
-        # Do once
-        if run_id == 1:
-
-            # Get and save subject metadata
-            # See: https://mne.tools/dev/generated/mne.Info.html
-            with open(
-                "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-                + subject_id
-                + "/info.json",
-                "w",
-            ) as outfile:
-                json.dump(raw.info["subject_info"], outfile)
-
-        # Get and save EEG coords (can vary per run)
-        eeg_coords = [ch["loc"][:3] for ch in raw.info["chs"] if "EEG" in ch["ch_name"]]
-        numpy.save(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-            + "/eeg_coords.npy",
-            eeg_coords,
-        )
-
-        # Correct EOG and ECG channel names
-        # See: https://www.nature.com/articles/sdata20151
-        raw.rename_channels({"EEG061": "HEOG", "EEG062": "VEOG", "EEG063": "ECG"})
-        raw.set_channel_types({"HEOG": "eog", "VEOG": "eog", "ECG": "ecg"})
-
-        # Bandpass filter between lowest and highest of freq bands
-        raw.filter(l_freq=1.0, h_freq=70)
-        raw.notch_filter(50)
-
-        # Resample according to Shannon-Nyquist and highest freq band
-        raw.resample(145)
-
-        # ICA
-        ica = mne.preprocessing.ICA(n_components=16, max_iter="auto", random_state=97)
-        ica.fit(raw)
-        ica.exclude = []
-        eog_indices, eog_scores = ica.find_bads_eog(
-            raw
-        )  # Use EOG to find bad components
-        ecg_indices, ecg_scores = ica.find_bads_ecg(
-            raw, method="correlation", threshold="auto"
-        )  # Use ECG to find bad components
-        plot = ica.plot_sources(
-            raw, stop=10, show_scrollbars=False
-        )  # Plot ICA comps for first 10 seconds
-        plot.savefig(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-            + "/ICA.pdf"
-        )
-        ica.exclude = eog_indices + ecg_indices
-        ica.apply(raw)  # Apply
-
-        # Pick MEG and EEG channels
-        raw.pick_types(meg="mag", eeg=True)
-
-        # Create and save downsampled copy for average view
-        downsampled = raw.copy().resample(45)
-        downsampled.save(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-            + "/processed_downsampled.fif"
-        )
-        downsampled.annotations.save(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-            + "/processed_downsampled_annotations.fif"
-        )
 
-        # Save
-        raw.save(
-            "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
-            + subject_id
-            + "/run"
-            + str(run_id)
-            + "/processed.fif"
-        )
-        raw.annotations.save(
+def file_hash(path):
+
+    # Hash in chunks, raw runs do not fit in memory twice
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(16 * 1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_stat(path):
+
+    # Size and modification time, cheap enough to check on every run
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def run_bids_path(subject_id, run_id):
+    return mne_bids.BIDSPath(subject=subject_id.zfill(2), session="meg", task="facerecognition", datatype="meg", run=run_id, root="/scratch/brussel/102/vsc10248/info-vis-data/raw")
+
+
+def input_paths(subject_id, run_id, bids_path):
+
+    # The raw recording with its BIDS sidecar files, and the participants file (subject info)
+    prefix = (
+        "sub-"
+        + subject_id.zfill(2)
+        + "_ses-meg_task-facerecognition_run-"
+        + str(run_id).zfill(2)
+        + "_"
+    )
+    paths = sorted(glob.glob(os.path.join(bids_path.directory, prefix + "*")))
+    paths.append(os.path.join(bids_path.root, "participants.tsv"))
+
+    return {
+        os.path.relpath(path, bids_path.root): path
+        for path in paths
+        if os.path.exists(path)
+    }
+
+
+def input_stats(subject_id, run_id, bids_path):
+    return {
+        input_file: file_stat(input_path)
+        for input_file, input_path in input_paths(subject_id, run_id, bids_path).items()
+    }
+
+
+def input_hashes(subject_id, run_id, bids_path):
+    return {
+        input_file: file_hash(input_path)
+        for input_file, input_path in input_paths(subject_id, run_id, bids_path).items()
+    }
+
+
+def output_stats(subject_id, run_id):
+    return {
+        output_file: file_stat(os.path.join(run_folder(subject_id, run_id), output_file))
+        for output_file in output_files
+    }
+
+
+def output_hashes(subject_id, run_id):
+    return {
+        output_file: file_hash(os.path.join(run_folder(subject_id, run_id), output_file))
+        for output_file in output_files
+    }
+
+
+def read_manifest(subject_id, run_id):
+    manifest_path = os.path.join(run_folder(subject_id, run_id), "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(subject_id, run_id, manifest):
+
+    # Written last and atomically, a run with a manifest is complete
+    manifest_path = os.path.join(run_folder(subject_id, run_id), "manifest.json")
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def is_up_to_date(subject_id, run_id, inputs):
+    """
+    Checks whether a run was processed from the same inputs (sizes and modification times)
+    with the same parameters and whether all of its outputs are still as they were written
+    """
+    manifest = read_manifest(subject_id, run_id)
+    if manifest is None:
+        return False
+    if manifest.get("inputs") != inputs or manifest["parameters"] != parameters:
+        return False
+    if any([output_file not in manifest.get("outputs", {}) for output_file in output_files]):
+        return False
+
+    for output_file, output_stat in manifest["outputs"].items():
+        output_path = os.path.join(run_folder(subject_id, run_id), output_file)
+        if not os.path.exists(output_path) or file_stat(output_path) != output_stat:
+            return False
+
+    return True
+
+
+def verify_run(subject_id, run_id, deep=False):
+    """
+    Checks a processed run against its manifest, by size and modification time
+    or, when deep, by hashing its inputs and outputs
+    ---
+    output:
+        list of problems, empty if the run is valid
+    """
+    manifest = read_manifest(subject_id, run_id)
+    if manifest is None:
+        return ["no manifest"]
+    if deep and "output_hashes" not in manifest:
+        return ["no hashes in the manifest"]
+
+    problems = []
+    for output_file, output_stat in manifest.get("outputs", {}).items():
+        output_path = os.path.join(run_folder(subject_id, run_id), output_file)
+        if not os.path.exists(output_path):
+            problems.append(output_file + " is missing")
+        elif deep and file_hash(output_path) != manifest["output_hashes"][output_file]:
+            problems.append(output_file + " does not match the manifest")
+        elif not deep and file_stat(output_path) != output_stat:
+            problems.append(output_file + " changed since it was written")
+
+    # The inputs are hashed only when asked for, raw runs take long to read
+    if deep:
+        bids_path = run_bids_path(subject_id, run_id)
+        if input_hashes(subject_id, run_id, bids_path) != manifest["input_hashes"]:
+            problems.append("the inputs do not match the manifest")
+
+    return problems
+
+
+# ----
+# Processing
+# ----
+def limit_threads(threads):
+
+    # Keep the BLAS/OpenMP threads of each worker within its share of the CPUs:
+    # the environment covers the libraries loaded later on (e.g. by the ICA) and inherited by the workers,
+    # threadpoolctl the ones that are already loaded
+    if threads is None:
+        return
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[variable] = str(threads)
+    threadpoolctl.threadpool_limits(limits=threads)
+
+
+def process_run(subject_id, run_id):
+    """
+    Processes one run of a subject
+    ---
+    input:
+        subject number (as a string)
+        run number [1-6]
+    ---
+    output:
+        subject info of the run, None if the run could not be read
+    """
+
+    # Define path to files
+    bids_path = run_bids_path(subject_id, run_id)
+
+    # Skip runs that were already processed from the same inputs
+    inputs = input_stats(subject_id, run_id, bids_path)
+    if is_up_to_date(subject_id, run_id, inputs):
+        print("subject " + subject_id + " run " + str(run_id) + " is up to date")
+        return read_manifest(subject_id, run_id)["subject_info"]
+
+    # Read raw
+    raw = []
+    try:
+        raw = mne_bids.read_raw_bids(bids_path=bids_path)
+        raw.load_data()
+    except:
+        return None
+
+    # Make folder for run (it can remain from an earlier, failed attempt)
+    os.makedirs(run_folder(subject_id, run_id), exist_ok=True)
+
+    # The previous manifest no longer holds while the outputs are rewritten
+    if os.path.exists(os.path.join(run_folder(subject_id, run_id), "manifest.json")):
+        os.remove(os.path.join(run_folder(subject_id, run_id), "manifest.json"))
+
+    # Get and save EEG coords (can vary per run)
+    eeg_coords = [ch["loc"][:3] for ch in raw.info["chs"] if "EEG" in ch["ch_name"]]
+    numpy.save(
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
+        + subject_id
+        + "/run"
+        + str(run_id)
+        + "/eeg_coords.npy",
+        eeg_coords,
+    )
+
+    # Correct EOG and ECG channel names
+    # See: https://www.nature.com/articles/sdata20151
+    raw.rename_channels({"EEG061": "HEOG", "EEG062": "VEOG", "EEG063": "ECG"})
+    raw.set_channel_types({"HEOG": "eog", "VEOG": "eog", "ECG": "ecg"})
+
+    # Bandpass filter between lowest and highest of freq bands
+    raw.filter(l_freq=parameters["l_freq"], h_freq=parameters["h_freq"])
+    raw.notch_filter(parameters["notch_freq"])
+
+    # Resample according to Shannon-Nyquist and highest freq band
+    raw.resample(parameters["sfreq"])
+
+    # ICA
+    ica = mne.preprocessing.ICA(
+        n_components=parameters["ica_components"],
+        max_iter="auto",
+        random_state=parameters["ica_random_state"],
+    )
+    ica.fit(raw)
+    ica.exclude = []
+    eog_indices, eog_scores = ica.find_bads_eog(
+        raw
+    )  # Use EOG to find bad components
+    ecg_indices, ecg_scores = ica.find_bads_ecg(
+        raw, method="correlation", threshold="auto"
+    )  # Use ECG to find bad components
+    plot = ica.plot_sources(
+        raw, stop=10, show_scrollbars=False
+    )  # Plot ICA comps for first 10 seconds
+    plot.savefig(
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
+        + subject_id
+        + "/run"
+        + str(run_id)
+        + "/ICA.pdf"
+    )
+    ica.exclude = eog_indices + ecg_indices
+    ica.apply(raw)  # Apply
+
+    # Pick MEG and EEG channels
+    raw.pick_types(meg="mag", eeg=True)
+
+    # Save
+    raw.save(
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
+        + subject_id
+        + "/run"
+        + str(run_id)
+        + "/processed.fif",
+        overwrite=True,
+    )
+    raw.annotations.save(
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
+        + subject_id
+        + "/run"
+        + str(run_id)
+        + "/processed_annotations.fif",
+        overwrite=True,
+    )
+
+    # Save a memory-mappable copy for the visualisation
+    write_store(raw, run_folder(subject_id, run_id))
+
+    # Record what the outputs were made from
+    # See: https://mne.tools/dev/generated/mne.Info.html
+    subject_info = raw.info["subject_info"]
+    write_manifest(
+        subject_id,
+        run_id,
+        {
+            "inputs": inputs,
+            "input_hashes": input_hashes(subject_id, run_id, bids_path),
+            "parameters": parameters,
+            "outputs": output_stats(subject_id, run_id),
+            "output_hashes": output_hashes(subject_id, run_id),
+            "subject_info": subject_info,
+        },
+    )
+
+    return subject_info
+
+
+def process_subject(subject_id, workers=1, threads=None):
+
+    # Make subject folder
+    os.makedirs(
+        "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject" + subject_id,
+        exist_ok=True,
+    )
+
+    # Process runs, in parallel if there are multiple workers
+    run_ids = list(range(1, 7))
+    limit_threads(threads)
+    if workers > 1:
+        with multiprocessing.Pool(
+            workers, initializer=limit_threads, initargs=(threads,)
+        ) as pool:
+            subject_infos = pool.starmap(
+                process_run, [(subject_id, run_id) for run_id in run_ids]
+            )
+    else:
+        subject_infos = [process_run(subject_id, run_id) for run_id in run_ids]
+
+    # Save subject metadata of the first run (once all runs are done, independent of their order)
+    if subject_infos[0] is not None:
+        with open(
             "/scratch/brussel/102/vsc10248/info-vis-data/processed/subject"
             + subject_id
-            + "/run"
-            + str(run_id)
-            + "/processed_annotations.fif"
-        )
+            + "/info.json",
+            "w",
+        ) as outfile:
+            json.dump(subject_infos[0], outfile)
+
 
 if __name__ == "__main__":
-    process_subject(str(sys.argv[1]))
+    parser = argparse.ArgumentParser(description="Preprocess the runs of a subject")
+    parser.add_argument("subject_id", help="subject number [1-16]")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of runs processed in parallel",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="BLAS/OpenMP threads per worker (default: CPUs divided over the workers)",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="only check the outputs of processed runs against their manifests (sizes and modification times)",
+    )
+    parser.add_argument(
+        "--deep",
+        action="store_true",
+        help="with --verify, hash the inputs and outputs instead (slow)",
+    )
+    args = parser.parse_args()
+
+    if args.verify:
+        valid = True
+        for run_id in range(1, 7):
+            problems = verify_run(str(args.subject_id), run_id, args.deep)
+            print(
+                "subject "
+                + str(args.subject_id)
+                + " run "
+                + str(run_id)
+                + ": "
+                + ("ok" if len(problems) == 0 else ", ".join(problems))
+            )
+            valid = valid and len(problems) == 0
+        sys.exit(0 if valid else 1)
+
+    # Only count the CPUs this process may run on (e.g. those allocated by Slurm)
+    threads = args.threads
+    if threads is None:
+        threads = max(1, len(os.sched_getaffinity(0)) // args.workers)
+
+    process_subject(str(args.subject_id), args.workers, threads)
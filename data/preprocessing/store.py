@@ -0,0 +1,51 @@
+import mne
+import json
+import numpy
+
+# Event ids, in the order of the event names of the visualisation
+event_id = {"Famous": 1, "Scrambled": 2, "Unfamiliar": 3}
+
+# Units the data is stored in per channel type
+units = {"eeg": "uV", "mag": "fT"}
+
+def write_store(raw, folder):
+    """
+    Writes a processed run as a channel-major float32 array (processed.npy) that can be memory-mapped
+    and a sidecar (processed_store.json) holding the channel names and types, units,
+    sampling frequency, first sample and events
+    ---
+    input:
+        processed raw run (EEG and magnetometer channels)
+        folder of the run
+    """
+
+    # Fill the array one channel type at a time
+    ch_types = raw.get_channel_types()
+    data = numpy.lib.format.open_memmap(
+        folder + "/processed.npy",
+        mode="w+",
+        dtype=numpy.float32,
+        shape=(len(raw.ch_names), int(raw.n_times)),
+    )
+    for ch_type, unit in units.items():
+        picks = [idx for idx, channel_type in enumerate(ch_types) if channel_type == ch_type]
+        if len(picks) > 0:
+            data[picks] = raw.get_data(picks=picks, units=unit)
+    data.flush()
+    del data
+
+    # Events (samples include the first sample, as in mne)
+    events, _ = mne.events_from_annotations(raw, event_id=event_id)
+
+    with open(folder + "/processed_store.json", "w") as outfile:
+        json.dump(
+            {
+                "ch_names": raw.ch_names,
+                "ch_types": ch_types,
+                "units": units,
+                "sfreq": float(raw.info["sfreq"]),
+                "first_samp": int(raw.first_samp),
+                "events": events[:, [0, 2]].tolist(),
+            },
+            outfile,
+        )
@@ -10,19 +10,61 @@ from bokeh.models import (
     ResetTool,
     WheelZoomTool,
     HoverTool,
+    Label,
+    LinearColorMapper,
+    ColorBar,
 )
+from bokeh.events import RangesUpdate
+from bokeh.palettes import Viridis256
 from bokeh.plotting import figure
 
 import data_access
 
 # View
-view_size = 10 * 45
+view_size = 10 * data_access.sfreq
+
+# Number of columns the visible part of a run is reduced to
+view_columns = 1500
+
+
+# ----
+# Level of detail
+# ----
+def detail(group_levels, start, end):
+    """
+    Returns the envelope of a group average around the visible range from the coarsest level that fills the view,
+    padded with the width of the view on both sides to keep panning smooth
+    """
+    width = end - start
+    return data_access.envelope(
+        group_levels, math.floor(start - width), math.ceil(end + width), 3 * view_columns
+    )
+
+
+def data_range(y_range, group_levels):
+    """
+    Sets a y range to fixed bounds over the whole run, so it does not change with the level of detail
+    (read from the coarsest level of every group)
+    """
+    low = min([numpy.min(levels[-1][0]) for levels in group_levels])
+    high = max([numpy.max(levels[-1][1]) for levels in group_levels])
+    padding = 0.05 * (high - low)
+    y_range.update(
+        start=low - padding,
+        end=high + padding,
+        reset_start=low - padding,
+        reset_end=high + padding,
+    )
 
 
 # ----
 # Average plots
 # ----
-def avg_plots(EEG_avgs, EEG_line_visible, MEG_avgs, MEG_line_visible, events, logger):
+def avg_plots(EEG_levels, EEG_line_visible, MEG_levels, MEG_line_visible, events, logger):
+    """
+    Creates the plots of a whole run from the pyramid levels of its group averages (see data_access.load_levels),
+    they are shown again for other runs by passing those to the returned update function (same arguments, without the logger)
+    """
 
     # Tools
     tools = [
@@ -31,13 +73,6 @@ def avg_plots(EEG_avgs, EEG_line_visible, MEG_avgs, MEG_line_visible, events, lo
         WheelZoomTool(dimensions="width"),
     ]
 
-    # Ticks
-    run_lengths = [len(group_avg) for group_avg in list(EEG_avgs.values())]
-    x_ticks = {
-        i * data_access.avg_sfreq: str(i)
-        for i in range(round(max(run_lengths) / data_access.avg_sfreq) + 1)
-    }
-
     # EEG
     EEG_p = figure(
         title="EEG",
@@ -53,34 +88,32 @@ def avg_plots(EEG_avgs, EEG_line_visible, MEG_avgs, MEG_line_visible, events, lo
         outline_line_alpha = 0.8
     )
     EEG_p.x_range = Range1d(0, view_size)
+    EEG_p.y_range = Range1d(0, 1)
     EEG_p.xaxis.visible = False
     EEG_p.yaxis.axis_label = "µV"
     EEG_p.toolbar.logo = None
-    EEG_p.xaxis.ticker = [tick for tick in x_ticks.keys()]
-    EEG_p.xaxis.major_label_overrides = x_ticks
     EEG_p.yaxis.major_label_text_font = "arial"
     EEG_p.yaxis.axis_label_text_font = "arial"
     EEG_p.xgrid.grid_line_color = "#D4D4D4"
     EEG_p.ygrid.grid_line_color = "#D4D4D4"
 
-    EEG_lines = {group_name: [] for group_name in EEG_avgs.keys()}
-    for group_name, group_data in EEG_avgs.items():
-        source = ColumnDataSource(
-            dict(
-                x=numpy.arange(0, len(group_data), 1),
-                y=group_data,
-            )
-        )
+    # Level of detail, only the visible part of the run is sent at full resolution
+    # (pairs of source and pyramid levels of its group average)
+    sources = []
+
+    EEG_sources = {}
+    EEG_lines = {group_name: [] for group_name in EEG_levels.keys()}
+    for group_name in EEG_levels.keys():
+        EEG_sources[group_name] = ColumnDataSource(dict(x=[], y=[]))
         line = EEG_p.line(
             x="x",
             y="y",
             line_width=1,
-            source=source,
+            source=EEG_sources[group_name],
             line_color=data_access.group_colors[group_name],
             visible=EEG_line_visible[group_name],
         )
         EEG_lines[group_name].append(line)
-    EEG_p.y_range.renderers = [line for group in EEG_lines.values() for line in group]
 
     # MEG plot
     MEG_p = figure(
@@ -96,8 +129,7 @@ def avg_plots(EEG_avgs, EEG_line_visible, MEG_avgs, MEG_line_visible, events, lo
         outline_line_alpha = 0.8
     )
     MEG_p.x_range = EEG_p.x_range
-    MEG_p.xaxis.ticker = [tick for tick in x_ticks.keys()]
-    MEG_p.xaxis.major_label_overrides = x_ticks
+    MEG_p.y_range = Range1d(0, 1)
     MEG_p.xaxis.axis_label = "Time (s)"
     MEG_p.xaxis.axis_label_text_font = "arial"
     MEG_p.yaxis.axis_label_text_font = "arial"
@@ -108,99 +140,161 @@ def avg_plots(EEG_avgs, EEG_line_visible, MEG_avgs, MEG_line_visible, events, lo
     MEG_p.xgrid.grid_line_color = "#D4D4D4"
     MEG_p.ygrid.grid_line_color = "#D4D4D4"
 
-    MEG_lines = {group_name: [] for group_name in MEG_avgs.keys()}
-    for group_name, group_data in MEG_avgs.items():
-        source = ColumnDataSource(
-            dict(
-                x=numpy.arange(0, len(group_data), 1),
-                y=group_data,
-            )
-        )
+    MEG_sources = {}
+    MEG_lines = {group_name: [] for group_name in MEG_levels.keys()}
+    for group_name in MEG_levels.keys():
+        MEG_sources[group_name] = ColumnDataSource(dict(x=[], y=[]))
         line = MEG_p.line(
             x="x",
             y="y",
             line_width=1,
-            source=source,
+            source=MEG_sources[group_name],
             line_color=data_access.group_colors[group_name],
             visible=MEG_line_visible[group_name],
         )
         MEG_lines[group_name].append(line)
-    MEG_p.y_range.renderers = [line for group in MEG_lines.values() for line in group]
 
-    # Events
-    renderers = []
-    for event in events:
-        if event[0] <= max(run_lengths):
-            event_data = ColumnDataSource(
-                dict(
-                    event_type=[data_access.event_names[event[1] - 1]],
-                    color=[
-                        data_access.event_colors[data_access.event_names[event[1] - 1]]
-                    ],
-                )
-            )
+    def update_detail(event):
+        for source, group_levels in sources:
+            x, y = detail(group_levels, event.x0, event.x1)
+            source.data = dict(x=x, y=y)
+
+    EEG_p.on_event(RangesUpdate, update_detail)
+    MEG_p.on_event(RangesUpdate, update_detail)
+
+    # Events, drawn from one source shared by both plots
+    event_data = ColumnDataSource(dict(x=[], width=[], event_type=[], color=[]))
+
+    # EEG plot
+    span = Rect(
+        x="x",
+        y=0,
+        width="width",
+        height=10000,
+        width_units="data",
+        height_units="data",
+        line_alpha=0.1,
+        line_color=dict(field="color"),
+        fill_alpha=0.1,
+        fill_color=dict(field="color"),
+    )
+    renderers = [EEG_p.add_glyph(source_or_glyph=event_data, glyph=span)]
 
-            # EEG plot
-            span = Rect(
-                x=round(
-                    event[0] - (data_access.event_duration * data_access.avg_sfreq) / 2
-                ),
-                y=0,
-                width=data_access.event_duration * data_access.avg_sfreq,
-                height=10000,
-                width_units="data",
-                height_units="data",
-                line_alpha=0.1,
-                line_color=data_access.event_colors[
-                    data_access.event_names[event[1] - 1]
-                ],
-                fill_alpha=0.1,
-                fill_color=data_access.event_colors[
-                    data_access.event_names[event[1] - 1]
-                ],
-            )
-            renderers.append(EEG_p.add_glyph(source_or_glyph=event_data, glyph=span))
-
-            # MEG plot
-            span = Rect(
-                x=round(
-                    event[0] - (data_access.event_duration * data_access.avg_sfreq) / 2
-                ),
-                y=0,
-                width=data_access.event_duration * data_access.avg_sfreq,
-                height=100000,
-                width_units="data",
-                height_units="data",
-                line_alpha=0.15,
-                line_color=data_access.event_colors[
-                    data_access.event_names[event[1] - 1]
-                ],
-                fill_alpha=0.15,
-                fill_color=data_access.event_colors[
-                    data_access.event_names[event[1] - 1]
-                ],
-            )
-            renderers.append(MEG_p.add_glyph(source_or_glyph=event_data, glyph=span))
+    # MEG plot
+    span = Rect(
+        x="x",
+        y=0,
+        width="width",
+        height=100000,
+        width_units="data",
+        height_units="data",
+        line_alpha=0.15,
+        line_color=dict(field="color"),
+        fill_alpha=0.15,
+        fill_color=dict(field="color"),
+    )
+    renderers.append(MEG_p.add_glyph(source_or_glyph=event_data, glyph=span))
 
     hovertool = HoverTool(renderers=renderers, tooltips=[("Event type", "@event_type")])
     EEG_p.add_tools(hovertool)
     MEG_p.add_tools(hovertool)
 
-    return EEG_p, EEG_lines, MEG_p, MEG_lines
+    def update(EEG_levels, EEG_line_visible, MEG_levels, MEG_line_visible, events):
+
+        # Ticks
+        run_length = max(
+            [
+                data_access.pyramid_base(group_levels)[1]
+                for group_levels in EEG_levels.values()
+            ]
+        )
+        x_ticks = {
+            i * data_access.sfreq: str(i)
+            for i in range(round(run_length / data_access.sfreq) + 1)
+        }
+        for p in [EEG_p, MEG_p]:
+            p.xaxis.ticker = [tick for tick in x_ticks.keys()]
+            p.xaxis.major_label_overrides = x_ticks
+
+        # Start at the beginning of the run
+        EEG_p.x_range.update(start=0, end=view_size)
+
+        # Lines
+        sources.clear()
+        for levels, line_visible, group_sources, lines, p in [
+            (EEG_levels, EEG_line_visible, EEG_sources, EEG_lines, EEG_p),
+            (MEG_levels, MEG_line_visible, MEG_sources, MEG_lines, MEG_p),
+        ]:
+            for group_name, group_levels in levels.items():
+                x, y = detail(group_levels, 0, view_size)
+                group_sources[group_name].data = dict(x=x, y=y)
+                sources.append((group_sources[group_name], group_levels))
+                for line in lines[group_name]:
+                    line.visible = line_visible[group_name]
+            data_range(p.y_range, levels.values())
+
+        # Events
+        event_length = data_access.event_duration * data_access.sfreq
+        events = numpy.asarray(events, dtype=int).reshape(-1, 2)
+        events = events[events[:, 0] <= run_length]
+        event_types = [data_access.event_names[event_id - 1] for event_id in events[:, 1]]
+        event_data.data = dict(
+            x=numpy.round(events[:, 0] - event_length / 2),
+            width=numpy.full(len(events), event_length),
+            event_type=event_types,
+            color=[data_access.event_colors[event_type] for event_type in event_types],
+        )
+
+    update(EEG_levels, EEG_line_visible, MEG_levels, MEG_line_visible, events)
+
+    return EEG_p, EEG_lines, MEG_p, MEG_lines, update
 
 
 # ----
 # Window plots
 # ----
+def band_data(group_names, window_group_avgs=None, window_group_errors=None):
+    """
+    Returns the columns of the bands around the windows of all groups, sharing one x column
+    ---
+    input:
+        group names
+        dict of windowed average per group (empty bands if not given)
+        dict of standard error of the windowed average per group
+    ---
+    output:
+        dict of columns
+    """
+
+    if window_group_avgs is None:
+        data = {"x": []}
+        for group_name in group_names:
+            data[group_name + " lower"] = []
+            data[group_name + " upper"] = []
+        return data
+
+    data = {"x": numpy.arange(0, len(next(iter(window_group_avgs.values()))), 1)}
+    for group_name in group_names:
+        data[group_name + " lower"] = window_group_avgs[group_name] - window_group_errors[group_name]
+        data[group_name + " upper"] = window_group_avgs[group_name] + window_group_errors[group_name]
+    return data
+
+
 def window_plots(
     EEG_window_group_avgs,
+    EEG_window_group_errors,
     EEG_line_visible,
     MEG_window_group_avgs,
+    MEG_window_group_errors,
     MEG_line_visible,
     tmin,
     tplus,
     logger,
 ):
+    """
+    Creates the plots of the windows around the selected events, with a band of ± the standard error around each line,
+    they are shown again for other windows by passing those to the returned update function (same arguments, without the logger)
+    """
 
     # Tools
     tools = [
@@ -209,12 +303,6 @@ def window_plots(
         WheelZoomTool(dimensions="width"),
     ]
 
-    # Ticks
-    x_ticks = {
-        math.floor(i * 145): str(round(i, 2))
-        for i in numpy.arange(0, math.ceil(-tmin + tplus) + 0.1, 0.1)
-    }
-
     # EEG
     EEG_p = figure(
         title="EEG",
@@ -228,8 +316,6 @@ def window_plots(
         outline_line_width = 1,
         outline_line_alpha = 0.8
     )
-    EEG_p.xaxis.ticker = [tick for tick in x_ticks.keys()]
-    EEG_p.xaxis.major_label_overrides = x_ticks
     EEG_p.xaxis.visible = False
     EEG_p.yaxis.axis_label = "µV"
     EEG_p.toolbar.logo = None
@@ -238,19 +324,26 @@ def window_plots(
     EEG_p.yaxis.major_label_text_font = "arial"
     EEG_p.yaxis.axis_label_text_font = "arial"
 
+    EEG_sources = {}
     EEG_lines = {group_name: [] for group_name in EEG_window_group_avgs.keys()}
-    for group_name, group_data in EEG_window_group_avgs.items():
-        source = ColumnDataSource(
-            dict(
-                x=numpy.arange(0, len(group_data), 1),
-                y=group_data,
-            )
+    EEG_bands = ColumnDataSource(band_data(EEG_window_group_avgs.keys()))
+    for group_name in EEG_window_group_avgs.keys():
+        EEG_sources[group_name] = ColumnDataSource(dict(x=[], y=[]))
+        band = EEG_p.varea(
+            x="x",
+            y1=group_name + " lower",
+            y2=group_name + " upper",
+            source=EEG_bands,
+            fill_color=data_access.group_colors[group_name],
+            fill_alpha=0.2,
+            visible=EEG_line_visible[group_name],
         )
+        EEG_lines[group_name].append(band)
         line = EEG_p.line(
             x="x",
             y="y",
             line_width=1,
-            source=source,
+            source=EEG_sources[group_name],
             line_color=data_access.group_colors[group_name],
             visible=EEG_line_visible[group_name],
         )
@@ -270,8 +363,6 @@ def window_plots(
         outline_line_alpha = 0.8
     )
     MEG_p.x_range = EEG_p.x_range
-    MEG_p.xaxis.ticker = [tick for tick in x_ticks.keys()]
-    MEG_p.xaxis.major_label_overrides = x_ticks
     MEG_p.xaxis.axis_label = "Time (s)"
     MEG_p.yaxis.axis_label = "fT"
     MEG_p.toolbar.logo = None
@@ -282,19 +373,26 @@ def window_plots(
     MEG_p.xaxis.major_label_text_font = "arial"
     MEG_p.yaxis.major_label_text_font = "arial"
 
+    MEG_sources = {}
     MEG_lines = {group_name: [] for group_name in MEG_window_group_avgs.keys()}
-    for group_name, group_data in MEG_window_group_avgs.items():
-        source = ColumnDataSource(
-            dict(
-                x=numpy.arange(0, len(group_data), 1),
-                y=group_data,
-            )
+    MEG_bands = ColumnDataSource(band_data(MEG_window_group_avgs.keys()))
+    for group_name in MEG_window_group_avgs.keys():
+        MEG_sources[group_name] = ColumnDataSource(dict(x=[], y=[]))
+        band = MEG_p.varea(
+            x="x",
+            y1=group_name + " lower",
+            y2=group_name + " upper",
+            source=MEG_bands,
+            fill_color=data_access.group_colors[group_name],
+            fill_alpha=0.2,
+            visible=MEG_line_visible[group_name],
         )
+        MEG_lines[group_name].append(band)
         line = MEG_p.line(
             x="x",
             y="y",
             line_width=1,
-            source=source,
+            source=MEG_sources[group_name],
             line_color=data_access.group_colors[group_name],
             visible=MEG_line_visible[group_name],
         )
@@ -302,28 +400,113 @@ def window_plots(
     MEG_p.y_range.renderers = [line for group in MEG_lines.values() for line in group]
 
     # Event line
-    EEG_p.add_layout(
+    spans = [
         Span(
-            location=math.floor(-tmin * 145),
+            location=0,
             dimension="height",
             line_color="#E70000",
-        )
-    )
-    MEG_p.add_layout(
+        ),
         Span(
-            location=math.floor(-tmin * 145),
+            location=0,
             dimension="height",
             line_color="#E70000",
-        )
+        ),
+    ]
+    EEG_p.add_layout(spans[0])
+    MEG_p.add_layout(spans[1])
+
+    def update(
+        EEG_window_group_avgs,
+        EEG_window_group_errors,
+        EEG_line_visible,
+        MEG_window_group_avgs,
+        MEG_window_group_errors,
+        MEG_line_visible,
+        tmin,
+        tplus,
+    ):
+
+        # Ticks
+        x_ticks = {
+            math.floor(i * 145): str(round(i, 2))
+            for i in numpy.arange(0, math.ceil(-tmin + tplus) + 0.1, 0.1)
+        }
+        for p in [EEG_p, MEG_p]:
+            p.xaxis.ticker = [tick for tick in x_ticks.keys()]
+            p.xaxis.major_label_overrides = x_ticks
+
+        # Lines and bands
+        for (
+            window_group_avgs,
+            window_group_errors,
+            line_visible,
+            group_sources,
+            bands,
+            lines,
+        ) in [
+            (
+                EEG_window_group_avgs,
+                EEG_window_group_errors,
+                EEG_line_visible,
+                EEG_sources,
+                EEG_bands,
+                EEG_lines,
+            ),
+            (
+                MEG_window_group_avgs,
+                MEG_window_group_errors,
+                MEG_line_visible,
+                MEG_sources,
+                MEG_bands,
+                MEG_lines,
+            ),
+        ]:
+            for group_name, group_data in window_group_avgs.items():
+                group_sources[group_name].data = dict(
+                    x=numpy.arange(0, len(group_data), 1),
+                    y=group_data,
+                )
+                for line in lines[group_name]:
+                    line.visible = line_visible[group_name]
+            bands.data = band_data(
+                window_group_avgs.keys(), window_group_avgs, window_group_errors
+            )
+
+        # Event line
+        for span in spans:
+            span.location = math.floor(-tmin * 145)
+
+    update(
+        EEG_window_group_avgs,
+        EEG_window_group_errors,
+        EEG_line_visible,
+        MEG_window_group_avgs,
+        MEG_window_group_errors,
+        MEG_line_visible,
+        tmin,
+        tplus,
     )
 
-    return EEG_p, EEG_lines, MEG_p, MEG_lines
+    return EEG_p, EEG_lines, MEG_p, MEG_lines, update
 
 
 # ----
 # PSD plots
 # ----
+def psd_data(freqs, psds):
+    """
+    Returns the spectra of a group's channels as the columns of one multi line source
+    """
+    psds = numpy.asarray(psds, dtype=numpy.float32)
+    freqs = numpy.broadcast_to(numpy.asarray(freqs, dtype=numpy.float32), psds.shape)
+    return dict(xs=list(freqs), ys=list(psds))
+
+
 def psd_plots(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible, logger):
+    """
+    Creates the plots of the power spectral densities,
+    they are shown again for other spectra by passing those to the returned update function (same arguments, without the logger)
+    """
 
     # Tools
     tools = [
@@ -333,7 +516,6 @@ def psd_plots(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible, logger):
     ]
 
     # Ticks
-    logger.info(EEG_psds)
     x_ticks = {
         i: str(i)
         for i in range(0, 85)
@@ -364,24 +546,18 @@ def psd_plots(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible, logger):
     EEG_p.yaxis.axis_label_text_font = "arial"
 
     EEG_lines = {group_name: [] for group_name in EEG_psds.keys()}
-    for group_name, group_data in EEG_psds.items():
-        freqs, psds = group_data
-        for channel_psd in psds:
-            source = ColumnDataSource(
-                dict(
-                    x=freqs,
-                    y=channel_psd,
-                )
-            )
-            line = EEG_p.line(
-                x="x",
-                y="y",
-                line_width=1,
-                source=source,
-                line_color=data_access.group_colors[group_name],
-                visible=EEG_line_visible[group_name],
-            )
-            EEG_lines[group_name].append(line)
+    EEG_sources = {}
+    for group_name in EEG_psds.keys():
+        EEG_sources[group_name] = ColumnDataSource(dict(xs=[], ys=[]))
+        lines = EEG_p.multi_line(
+            xs="xs",
+            ys="ys",
+            line_width=1,
+            source=EEG_sources[group_name],
+            line_color=data_access.group_colors[group_name],
+            visible=EEG_line_visible[group_name],
+        )
+        EEG_lines[group_name].append(lines)
     EEG_p.y_range.renderers = [line for group in EEG_lines.values() for line in group]
 
     # MEG plot
@@ -410,24 +586,283 @@ def psd_plots(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible, logger):
     MEG_p.yaxis.major_label_text_font = "arial"
 
     MEG_lines = {group_name: [] for group_name in MEG_psds.keys()}
-    for group_name, group_data in MEG_psds.items():
-        freqs, psds = group_data
-        for channel_psd in psds:
-            source = ColumnDataSource(
-                dict(
-                    x=freqs,
-                    y=channel_psd,
+    MEG_sources = {}
+    for group_name in MEG_psds.keys():
+        MEG_sources[group_name] = ColumnDataSource(dict(xs=[], ys=[]))
+        lines = MEG_p.multi_line(
+            xs="xs",
+            ys="ys",
+            line_width=1,
+            source=MEG_sources[group_name],
+            line_color=data_access.group_colors[group_name],
+            visible=MEG_line_visible[group_name],
+        )
+        MEG_lines[group_name].append(lines)
+    MEG_p.y_range.renderers = [line for group in MEG_lines.values() for line in group]
+
+    def update(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible):
+        logger.info(EEG_psds)
+        for psds, line_visible, group_sources, lines in [
+            (EEG_psds, EEG_line_visible, EEG_sources, EEG_lines),
+            (MEG_psds, MEG_line_visible, MEG_sources, MEG_lines),
+        ]:
+            for group_name, group_data in psds.items():
+                group_sources[group_name].data = psd_data(*group_data)
+                for line in lines[group_name]:
+                    line.visible = line_visible[group_name]
+
+    update(EEG_psds, EEG_line_visible, MEG_psds, MEG_line_visible)
+
+    return EEG_p, EEG_lines, MEG_p, MEG_lines, update
+
+
+
+# ----
+# Spectrogram plots
+# ----
+
+# Frequency range of a group's spectrogram and the space between those of the groups (Hz)
+spectrogram_height = data_access.sfreq / 2
+spectrogram_gap = 10
+
+
+def spectrogram_data(spectrogram, offset):
+    """
+    Returns a group's spectrogram as the columns of an image source,
+    with the pixels centred on the segment times and frequencies
+    """
+    times, freqs, power = spectrogram
+    time_step = times[1] - times[0] if len(times) > 1 else 2 * times[0]
+    freq_step = freqs[1] - freqs[0]
+    return dict(
+        image=[power],
+        x=[times[0] - time_step / 2],
+        y=[offset - freq_step / 2],
+        dw=[len(times) * time_step],
+        dh=[len(freqs) * freq_step],
+    )
+
+
+def spectrogram_plots(
+    EEG_spectrograms,
+    EEG_line_visible,
+    MEG_spectrograms,
+    MEG_line_visible,
+    event_time,
+    logger,
+):
+    """
+    Creates the plots of the group spectrograms, stacked with the first group at the top
+    and with a line at the event if its time is given (windows),
+    they are shown again for other spectrograms by passing those to the returned update function (same arguments, without the logger)
+    """
+
+    # Tools
+    tools = [
+        PanTool(dimensions="width"),
+        ResetTool(),
+        WheelZoomTool(dimensions="width"),
+    ]
+
+    # Each group has its own band of the frequency axis
+    EEG_offsets = {
+        group_name: (len(EEG_spectrograms) - 1 - group_idx)
+        * (spectrogram_height + spectrogram_gap)
+        for group_idx, group_name in enumerate(EEG_spectrograms.keys())
+    }
+    MEG_offsets = {
+        group_name: (len(MEG_spectrograms) - 1 - group_idx)
+        * (spectrogram_height + spectrogram_gap)
+        for group_idx, group_name in enumerate(MEG_spectrograms.keys())
+    }
+
+    # EEG
+    EEG_p = figure(
+        title="EEG",
+        tools=tools,
+        toolbar_location="right",
+        toolbar_sticky=False,
+        sizing_mode="stretch_both",
+        background_fill_color = "#E8FCFF",
+        border_fill_color = "#E8FCFF",
+        outline_line_color="#D4D4D4",
+        outline_line_width = 1,
+        outline_line_alpha = 0.8
+    )
+    EEG_p.y_range = Range1d(-spectrogram_gap / 2, max(EEG_offsets.values()) + spectrogram_height)
+    EEG_p.xaxis.visible = False
+    EEG_p.yaxis.axis_label = "Frequency (Hz)"
+    EEG_p.yaxis.ticker = [offset + i for offset in EEG_offsets.values() for i in range(0, 61, 20)]
+    EEG_p.yaxis.major_label_overrides = {
+        offset + i: str(i) for offset in EEG_offsets.values() for i in range(0, 61, 20)
+    }
+    EEG_p.toolbar.logo = None
+    EEG_p.xgrid.visible = False
+    EEG_p.ygrid.visible = False
+    EEG_p.yaxis.major_label_text_font = "arial"
+    EEG_p.yaxis.axis_label_text_font = "arial"
+
+    EEG_mapper = LinearColorMapper(palette=Viridis256)
+    EEG_p.add_layout(ColorBar(color_mapper=EEG_mapper, title="dB", width=10), "right")
+
+    EEG_lines = {group_name: [] for group_name in EEG_spectrograms.keys()}
+    EEG_sources = {}
+    for group_name in EEG_spectrograms.keys():
+        EEG_sources[group_name] = ColumnDataSource(
+            dict(image=[], x=[], y=[], dw=[], dh=[])
+        )
+        image = EEG_p.image(
+            image="image",
+            x="x",
+            y="y",
+            dw="dw",
+            dh="dh",
+            source=EEG_sources[group_name],
+            color_mapper=EEG_mapper,
+            visible=EEG_line_visible[group_name],
+        )
+        label = Label(
+            x=5,
+            y=EEG_offsets[group_name] + spectrogram_height,
+            x_units="screen",
+            text=group_name,
+            text_color=data_access.group_colors[group_name],
+            text_baseline="top",
+            text_font="arial",
+            text_font_size="9pt",
+            visible=EEG_line_visible[group_name],
+        )
+        EEG_p.add_layout(label)
+        EEG_lines[group_name].extend([image, label])
+
+    # MEG plot
+    MEG_p = figure(
+        title="MEG",
+        tools=tools,
+        toolbar_location=None,
+        sizing_mode="stretch_both",
+        background_fill_color = "#E8FCFF",
+        border_fill_color = "#E8FCFF",
+        outline_line_color="#D4D4D4",
+        outline_line_width = 1,
+        outline_line_alpha = 0.8
+    )
+    MEG_p.x_range = EEG_p.x_range
+    MEG_p.y_range = Range1d(-spectrogram_gap / 2, max(MEG_offsets.values()) + spectrogram_height)
+    MEG_p.xaxis.axis_label = "Time (s)"
+    MEG_p.yaxis.axis_label = "Frequency (Hz)"
+    MEG_p.yaxis.ticker = [offset + i for offset in MEG_offsets.values() for i in range(0, 61, 20)]
+    MEG_p.yaxis.major_label_overrides = {
+        offset + i: str(i) for offset in MEG_offsets.values() for i in range(0, 61, 20)
+    }
+    MEG_p.toolbar.logo = None
+    MEG_p.xgrid.visible = False
+    MEG_p.ygrid.visible = False
+    MEG_p.xaxis.axis_label_text_font = "arial"
+    MEG_p.yaxis.axis_label_text_font = "arial"
+    MEG_p.xaxis.major_label_text_font = "arial"
+    MEG_p.yaxis.major_label_text_font = "arial"
+
+    MEG_mapper = LinearColorMapper(palette=Viridis256)
+    MEG_p.add_layout(ColorBar(color_mapper=MEG_mapper, title="dB", width=10), "right")
+
+    MEG_lines = {group_name: [] for group_name in MEG_spectrograms.keys()}
+    MEG_sources = {}
+    for group_name in MEG_spectrograms.keys():
+        MEG_sources[group_name] = ColumnDataSource(
+            dict(image=[], x=[], y=[], dw=[], dh=[])
+        )
+        image = MEG_p.image(
+            image="image",
+            x="x",
+            y="y",
+            dw="dw",
+            dh="dh",
+            source=MEG_sources[group_name],
+            color_mapper=MEG_mapper,
+            visible=MEG_line_visible[group_name],
+        )
+        label = Label(
+            x=5,
+            y=MEG_offsets[group_name] + spectrogram_height,
+            x_units="screen",
+            text=group_name,
+            text_color=data_access.group_colors[group_name],
+            text_baseline="top",
+            text_font="arial",
+            text_font_size="9pt",
+            visible=MEG_line_visible[group_name],
+        )
+        MEG_p.add_layout(label)
+        MEG_lines[group_name].extend([image, label])
+
+    # Event line
+    spans = [
+        Span(
+            location=0,
+            dimension="height",
+            line_color="#E70000",
+        ),
+        Span(
+            location=0,
+            dimension="height",
+            line_color="#E70000",
+        ),
+    ]
+    EEG_p.add_layout(spans[0])
+    MEG_p.add_layout(spans[1])
+
+    def update(
+        EEG_spectrograms,
+        EEG_line_visible,
+        MEG_spectrograms,
+        MEG_line_visible,
+        event_time,
+    ):
+
+        # Images, the colors span the bulk of the power of the modality
+        for spectrograms, offsets, line_visible, group_sources, mapper, lines in [
+            (
+                EEG_spectrograms,
+                EEG_offsets,
+                EEG_line_visible,
+                EEG_sources,
+                EEG_mapper,
+                EEG_lines,
+            ),
+            (
+                MEG_spectrograms,
+                MEG_offsets,
+                MEG_line_visible,
+                MEG_sources,
+                MEG_mapper,
+                MEG_lines,
+            ),
+        ]:
+            for group_name, group_data in spectrograms.items():
+                group_sources[group_name].data = spectrogram_data(
+                    group_data, offsets[group_name]
                 )
+                for line in lines[group_name]:
+                    line.visible = line_visible[group_name]
+            low, high = numpy.percentile(
+                [group_data[2] for group_data in spectrograms.values()], [2, 98]
             )
-            line = MEG_p.line(
-                x="x",
-                y="y",
-                line_width=1,
-                source=source,
-                line_color=data_access.group_colors[group_name],
-                visible=MEG_line_visible[group_name],
-            )
-            MEG_lines[group_name].append(line)
-    MEG_p.y_range.renderers = [line for group in MEG_lines.values() for line in group]
+            mapper.low = float(low)
+            mapper.high = float(high)
+
+        # Event line
+        for span in spans:
+            span.visible = event_time is not None
+            if event_time is not None:
+                span.location = event_time
+
+    update(
+        EEG_spectrograms,
+        EEG_line_visible,
+        MEG_spectrograms,
+        MEG_line_visible,
+        event_time,
+    )
 
-    return EEG_p, EEG_lines, MEG_p, MEG_lines
+    return EEG_p, EEG_lines, MEG_p, MEG_lines, update
@@ -1,10 +1,368 @@
 import mne
+import math
 import numpy
 import json
+import os
+import hashlib
+import site
+import threading
+import multiprocessing
 
-from scipy import signal
+from collections import OrderedDict
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    ProcessPoolExecutor,
+    CancelledError,
+)
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, lru_cache
+from scipy import signal, fft
 from bokeh.palettes import Colorblind
 
+# Background work (reading runs, computing averages) shared by all sessions
+executor = ThreadPoolExecutor(max_workers=4)
+
+# Worker processes for work across subjects, started on first use (see process_executor)
+process_pool = None
+process_pool_lock = threading.Lock()
+
+
+def process_executor():
+    """
+    Returns the pool of worker processes, the workers are spawned rather than forked
+    since the server process has threads running,
+    they import this module from its folder (panel serve only has it on the path while it runs the app script)
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=site.addsitedir,
+                initargs=(os.path.dirname(os.path.abspath(__file__)),),
+            )
+    return process_pool
+
+
+def forget_process_pool(pool):
+    """
+    Drops a pool of worker processes that broke (e.g. a worker died), the next work starts a new pool
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is pool:
+            process_pool = None
+    pool.shutdown(wait=False)
+
+
+def submit_process(function, *args):
+    """
+    Submits work to the worker processes (see process_executor),
+    replacing the pool when it is broken so one failure does not fail all later work
+    ---
+    input:
+        function to call in a worker process (importable from this module)
+        arguments of the function
+    ---
+    output:
+        future of the result
+    """
+
+    pool = process_executor()
+    try:
+        future = pool.submit(function, *args)
+    except BrokenProcessPool:
+        forget_process_pool(pool)
+        pool = process_executor()
+        future = pool.submit(function, *args)
+
+    def check(future):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            forget_process_pool(pool)
+
+    future.add_done_callback(check)
+    return future
+
+
+# ----
+# Cache
+# ----
+
+# Subject data and derived results shared by all sessions of the server process,
+# least recently used entries are evicted once their size exceeds the budget (in bytes)
+cache_budget = 2 * 1024**3
+cache_lock = threading.Lock()
+cache_entries = OrderedDict()
+cache_pending = {}
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def cache_size(value):
+    """
+    Estimates the memory used by a cached value from the numpy arrays it holds
+    """
+    if isinstance(value, numpy.memmap):
+        return 0  # backed by its file, pages are read on demand
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum([cache_size(item) for item in value.values()])
+    if isinstance(value, (list, tuple)):
+        return sum([cache_size(item) for item in value])
+    if isinstance(getattr(value, "_data", None), numpy.ndarray):
+        return value._data.nbytes
+    return 0
+
+
+def cache_evict():
+    # Expects the cache lock to be held
+    while cache_stats["bytes"] > cache_budget and len(cache_entries) > 0:
+        _, (_, size) = cache_entries.popitem(last=False)
+        cache_stats["bytes"] -= size
+        cache_stats["evictions"] += 1
+
+
+def set_cache_budget(budget):
+    """
+    Changes the cache budget (in bytes), evicting entries if needed
+    """
+    global cache_budget
+
+    with cache_lock:
+        cache_budget = budget
+        cache_evict()
+
+
+def cache_info():
+    """
+    Returns the cache counters (hits, misses, evictions), its size in bytes and its number of entries
+    """
+    with cache_lock:
+        return dict(cache_stats, entries=len(cache_entries), budget=cache_budget)
+
+
+def cache_get(key):
+    """
+    Returns the cached value for a key, None if it is not cached
+    """
+    with cache_lock:
+        if key not in cache_entries:
+            return None
+        cache_entries.move_to_end(key)
+        cache_stats["hits"] += 1
+        return cache_entries[key][0]
+
+
+def cached(key, compute):
+    """
+    Returns the cached value for a key, computing and caching it on a miss
+    ---
+    input:
+        hashable key (e.g. a tuple of the kind of value, the subject and the parameters)
+        function without arguments that computes the value
+    ---
+    output:
+        value
+    """
+
+    with cache_lock:
+        if key in cache_entries:
+            cache_entries.move_to_end(key)
+            cache_stats["hits"] += 1
+            return cache_entries[key][0]
+
+        # Wait for sessions that are already computing the same value
+        pending = cache_pending.get(key)
+        if pending is None:
+            cache_stats["misses"] += 1
+            cache_pending[key] = Future()
+        else:
+            cache_stats["hits"] += 1
+    if pending is not None:
+        return pending.result()
+
+    try:
+        value = compute()
+    except BaseException as exception:
+        with cache_lock:
+            cache_pending.pop(key).set_exception(exception)
+        raise
+
+    size = cache_size(value)
+    with cache_lock:
+        if size <= cache_budget:
+            cache_entries[key] = (value, size)
+            cache_stats["bytes"] += size
+            cache_evict()
+        cache_pending.pop(key).set_result(value)
+
+    return value
+
+
+def cached_future(key, submit):
+    """
+    Returns a future of the cached value for a key without waiting for it,
+    on a miss the value is computed by the future that submit returns (e.g. of a worker process)
+    and cached once it is done, sessions that are already computing the same value share their future
+    ---
+    input:
+        hashable key (see cached)
+        function without arguments that starts computing the value and returns its future
+    ---
+    output:
+        future of the value
+    """
+
+    with cache_lock:
+        if key in cache_entries:
+            cache_entries.move_to_end(key)
+            cache_stats["hits"] += 1
+            future = Future()
+            future.set_result(cache_entries[key][0])
+            return future
+
+        pending = cache_pending.get(key)
+        if pending is not None:
+            cache_stats["hits"] += 1
+            return pending
+        cache_stats["misses"] += 1
+        pending = Future()
+        cache_pending[key] = pending
+
+    def store(future):
+        if future.cancelled() or future.exception() is not None:
+            with cache_lock:
+                cache_pending.pop(key)
+            pending.set_exception(
+                CancelledError() if future.cancelled() else future.exception()
+            )
+            return
+
+        value = future.result()
+        size = cache_size(value)
+        with cache_lock:
+            if size <= cache_budget:
+                cache_entries[key] = (value, size)
+                cache_stats["bytes"] += size
+                cache_evict()
+            cache_pending.pop(key)
+        pending.set_result(value)
+
+    try:
+        submit().add_done_callback(store)
+    except BaseException as exception:
+        with cache_lock:
+            cache_pending.pop(key)
+        pending.set_exception(exception)
+
+    return pending
+
+# ----
+# Disk cache
+# ----
+
+# Derived results are stored here and reused until the files they are derived from change
+cache_directory = "data/cache"
+
+
+def flatten(value, arrays):
+    """
+    Describes nested dicts, lists and tuples of numpy arrays as a JSON serialisable structure,
+    collecting the arrays (named by their position) in the given dict
+    """
+    if isinstance(value, numpy.ndarray):
+        name = "array" + str(len(arrays))
+        arrays[name] = value
+        return {"type": "array", "name": name}
+    if isinstance(value, dict):
+        return {
+            "type": "dict",
+            "items": [[flatten(key, arrays), flatten(item, arrays)] for key, item in value.items()],
+        }
+    if isinstance(value, (list, tuple)):
+        return {
+            "type": type(value).__name__,
+            "items": [flatten(item, arrays) for item in value],
+        }
+    if isinstance(value, numpy.generic):
+        value = value.item()
+    return {"type": "value", "value": value}
+
+
+def unflatten(structure, arrays):
+    """
+    Rebuilds a value from its structure and arrays (see flatten)
+    """
+    if structure["type"] == "array":
+        return arrays[structure["name"]]
+    if structure["type"] == "dict":
+        return {
+            unflatten(key, arrays): unflatten(item, arrays)
+            for key, item in structure["items"]
+        }
+    if structure["type"] == "list":
+        return [unflatten(item, arrays) for item in structure["items"]]
+    if structure["type"] == "tuple":
+        return tuple([unflatten(item, arrays) for item in structure["items"]])
+    return structure["value"]
+
+
+def disk_cached(name, sources, params, compute):
+    """
+    Returns results stored in the disk cache, computing and storing them if they are missing
+    or if the files they are derived from were modified since they were stored
+    ---
+    input:
+        name of the results
+        paths of the files the results are derived from
+        parameters the results depend on (their repr is used as key)
+        function without arguments that computes the results
+        (nested dicts, lists and tuples of numpy arrays, numbers and strings)
+    ---
+    output:
+        results
+    """
+
+    path = os.path.join(
+        cache_directory,
+        name + "-" + hashlib.sha1(repr(params).encode()).hexdigest() + ".npz",
+    )
+    fingerprint = numpy.array(
+        [[os.stat(source).st_mtime_ns, os.stat(source).st_size] for source in sources]
+    )
+
+    # Hit
+    if os.path.exists(path):
+        with numpy.load(path, allow_pickle=False) as stored:
+            if numpy.array_equal(stored["fingerprint"], fingerprint):
+                arrays = {key: stored[key] for key in stored.files}
+                return unflatten(json.loads(str(arrays["structure"])), arrays)
+
+    # Miss, write to a temporary file first so other processes never read a partial file
+    value = compute()
+    arrays = {}
+    structure = flatten(value, arrays)
+    os.makedirs(cache_directory, exist_ok=True)
+    temporary_path = (
+        path[: -len(".npz")]
+        + "-"
+        + str(os.getpid())
+        + "-"
+        + str(threading.get_ident())
+        + ".npz"
+    )
+    numpy.savez(
+        temporary_path,
+        structure=numpy.array(json.dumps(structure)),
+        fingerprint=fingerprint,
+        **arrays,
+    )
+    os.replace(temporary_path, path)
+
+    return value
+
+
 # ----
 # Subject info
 # ----
@@ -16,6 +374,95 @@ def parse_metadata():
     return as_dict
 
 
+def parse_metadata_arrays():
+    """
+    Parses the binary metadata (written by data/preprocessing/extract_metadata.py)
+    ---
+    output:
+        metadata with the same keys as metadata.json and the triangles of the cap meshes,
+        coordinates and faces as numpy arrays
+    """
+
+    with numpy.load("data/processed/metadata.npz") as arrays:
+        group_names = arrays["group_names"]
+        metadata = {
+            "meg_names": arrays["meg_names"].tolist(),
+            "meg_types": group_names[arrays["meg_group_codes"]].tolist(),
+            "eeg_names": arrays["eeg_names"].tolist(),
+            "eeg_types": group_names[arrays["eeg_group_codes"]].tolist(),
+            "meg_coords": arrays["meg_coords"],
+            "meg_mesh_coords": arrays["meg_mesh_coords"],
+            "meg_mesh_faces": arrays["meg_mesh_faces"],
+            "subjects": [
+                {
+                    "id": int(subject_id),
+                    "name": "subject " + str(subject_id),
+                    "age": int(age),
+                    "sex": str(sex),
+                    "eeg_coords": eeg_coords,
+                    "mesh_coords": mesh_coords,
+                    "mesh_faces": arrays["mesh_faces_" + str(subject_id)],
+                }
+                for subject_id, age, sex, eeg_coords, mesh_coords in zip(
+                    arrays["subject_ids"],
+                    arrays["subject_ages"],
+                    arrays["subject_sexes"],
+                    arrays["eeg_coords"],
+                    arrays["mesh_coords"],
+                )
+            ],
+        }
+
+    return metadata
+
+
+def groups_assignment(channel_names, channel_types):
+    """
+    Assigns the channels of a modality to their groups
+    ---
+    input:
+        channel names
+        group name of each channel
+    ---
+    output:
+        dict of channel names per group, groups in order of first appearance
+    """
+
+    channel_names = numpy.asarray(channel_names)
+    channel_types = numpy.asarray(channel_types)
+    _, first = numpy.unique(channel_types, return_index=True)
+
+    return {
+        str(group_name): channel_names[channel_types == group_name].tolist()
+        for group_name in channel_types[numpy.sort(first)]
+    }
+
+
+def load_metadata():
+    """
+    Returns the metadata with the channel groups of both modalities (see channel_groups),
+    parsed only once per server process from metadata.npz, or metadata.json when there is no binary version
+    """
+
+    def compute():
+        if os.path.exists("data/processed/metadata.npz"):
+            metadata = parse_metadata_arrays()
+        else:
+            metadata = parse_metadata()
+
+        metadata["eeg_groups"] = channel_groups(
+            metadata["eeg_names"],
+            groups_assignment(metadata["eeg_names"], metadata["eeg_types"]),
+        )
+        metadata["meg_groups"] = channel_groups(
+            metadata["meg_names"],
+            groups_assignment(metadata["meg_names"], metadata["meg_types"]),
+        )
+        return metadata
+
+    return cached(("metadata",), compute)
+
+
 # -----
 # Constants
 # -----
@@ -49,16 +496,69 @@ event_duration = 0.8
 minimum_min = 1.5  # (interstimulus interval is 1.7 so 1.5 for safety)
 maximum_max = 1.5
 
+# Layout of the window sums, part of their disk cache key so stored sums of an older layout are recomputed
+window_sums_layout = 2
+
 # Sampling frequency
 sfreq = 145
 
-# Average downsampled sampling frequency
-avg_sfreq = 45
+# Number of epochs read at once when summing windows
+epoch_chunk = 32
+
+# Spectrogram segments in samples, of whole runs and of windows
+spectrogram_window = 128
+spectrogram_step = 32
+window_spectrogram_window = 64
+window_spectrogram_step = 4
+
+# Number of segments transformed at once
+spectrogram_chunk = 128
+
+# Frequency bands within the 1-70 Hz the runs are filtered to (Hz)
+frequency_bands = {
+    "Delta": (1, 4),
+    "Theta": (4, 8),
+    "Alpha": (8, 13),
+    "Beta": (13, 30),
+    "Gamma": (30, 70),
+}
+
+# Order of the band-pass filters
+band_order = 4
+
+# Number of channels band-passed at once
+band_chunk = 64
 
 
 # ----
 # Runs
 # ----
+def run_path(subject, run, file_name):
+    """
+    Returns the path of one of the files of a subject's processed run
+    """
+    return (
+        "data/processed/subject" + str(subject) + "/run" + str(run) + "/" + file_name
+    )
+
+
+def run_sources(subject, run):
+    """
+    Returns the paths of the files a subject's run is parsed from,
+    including its store when it has one (which is read rather than the raw run, see run_reader)
+    """
+    sources = [
+        run_path(subject, run, "processed.fif"),
+        run_path(subject, run, "processed_annotations.fif"),
+    ]
+    if os.path.exists(run_path(subject, run, "processed.npy")):
+        sources += [
+            run_path(subject, run, "processed.npy"),
+            run_path(subject, run, "processed_store.json"),
+        ]
+    return sources
+
+
 def parse_run(subject, run):
     """
     Parses a subject's run
@@ -69,200 +569,1332 @@ def parse_run(subject, run):
     ---
     output:
         raw run
-        downsampled run
     """
 
     # Read raw run
     raw = mne.io.read_raw_fif(
-        "data/processed/subject" + str(subject) + "/run" + str(run) + "/processed.fif",
+        run_path(subject, run, "processed.fif"),
         verbose=None,
     )
     annotations = mne.read_annotations(
-        "data/processed/subject"
-        + str(subject)
-        + "/run"
-        + str(run)
-        + "/processed_annotations.fif",
+        run_path(subject, run, "processed_annotations.fif"),
     )
     raw.set_annotations(annotations)
 
-    # Read downsampled run
-    downsampled = mne.io.read_raw_fif(
-        "data/processed/subject"
-        + str(subject)
-        + "/run"
-        + str(run)
-        + "/processed_downsampled.fif",
-        verbose=None,
-    )
-    downsampled_annotations = mne.read_annotations(
-        "data/processed/subject"
-        + str(subject)
-        + "/run"
-        + str(run)
-        + "/processed_downsampled_annotations.fif",
-    )
-    downsampled.set_annotations(downsampled_annotations)
+    return raw
+
+
+def load_run(subject, run):
+    """
+    Returns a subject's run, parsing it only once per server process
+    """
+    return cached(("run", subject, run), partial(parse_run, subject, run))
+
+
+def run_reader(subject, run, EEG_groups, MEG_groups):
+    """
+    Returns a function that returns the events of a subject's run with its EEG and MEG data,
+    from the memory-mapped store when the run has one (see store_data) and from the raw run otherwise (see run_data),
+    the data is only read on the first call
+    """
+    data = []
+    lock = threading.Lock()
 
-    return raw, downsampled
+    def read():
+        with lock:
+            if len(data) == 0:
+                if os.path.exists(run_path(subject, run, "processed.npy")):
+                    store = load_store(subject, run)
+                    data.extend(
+                        [
+                            load_events(subject, run)["events"],
+                            store_data(store, EEG_groups),
+                            store_data(store, MEG_groups),
+                        ]
+                    )
+                else:
+                    raw = load_run(subject, run)
+                    data.extend(
+                        [
+                            load_events(subject, run)["events"],
+                            *run_data(raw, EEG_groups, MEG_groups),
+                        ]
+                    )
+        return data
+
+    return read
 
 
 # ----
-# Group averages
+# Store
 # ----
-def group_averages(runs, EEG_groups_assignment, MEG_groups_assignment):
+def parse_store(subject, run):
     """
-    Parses and returns channel group averages for a given run as well as the transformed events
+    Opens the memory-mapped store of a subject's run (written by the preprocessing, see data/preprocessing/store.py)
     ---
     input:
-        raw runs
-        EEG group assignments
-        MEG group assignments
+        subject number [1-16]
+        run number [1-6]
     ---
     output:
-        list of runs each with dict of EEG runs average per group
-        list of runs each with dict of EEG psd per group
-        list of runs each with dict of MEG runs average per group
-        list of runs each with dict of MEG psd per group
-        list of events per run
+        dict with the channel names, sampling frequency, first sample,
+        events (sample, event id) and read-only data (channels x samples, EEG in µV and MEG in fT)
     """
 
-    # For each run
-    eeg_groups_data_per_run = []
-    eeg_groups_psd_per_run = []
-    meg_groups_data_per_run = []
-    meg_groups_psd_per_run = []
-    events_per_run = []
-    for run in runs:
+    with open(run_path(subject, run, "processed_store.json")) as infile:
+        store = json.load(infile)
 
-        # Split per EEG group
-        eeg_groups_data = {}
-        eeg_groups_psd = {}
-        for group_name, group_channels in EEG_groups_assignment.items():
-            assert len(group_channels) > 0
+    store["events"] = numpy.array(store["events"], dtype=int).reshape(-1, 2)
+    store["data"] = numpy.load(run_path(subject, run, "processed.npy"), mmap_mode="r")
+    store["positions"] = {
+        channel_name: idx for idx, channel_name in enumerate(store["ch_names"])
+    }
 
-            data = run.get_data(picks=group_channels, units="uV")
+    return store
 
-            # Store psd
-            eeg_groups_psd[group_name] = signal.welch(data, 145)
 
-            # Store mean
-            eeg_groups_data[group_name] = numpy.mean(data, axis=0)
+def load_store(subject, run):
+    """
+    Returns the store of a subject's run, opening it only once per server process
+    """
+    return cached(("store", subject, run), partial(parse_store, subject, run))
 
-        eeg_groups_data_per_run.append(eeg_groups_data)
-        eeg_groups_psd_per_run.append(eeg_groups_psd)
 
-        # Split per MEG group
-        meg_groups_data = {}
-        meg_groups_psd = {}
-        for group_name, group_channels in MEG_groups_assignment.items():
-            assert len(group_channels) > 0
+def store_data(store, groups, start=None, stop=None):
+    """
+    Returns the data of a modality from a store,
+    without copying when its channels are stored next to each other and in the same order
+    ---
+    input:
+        store
+        channel groups of the modality
+        first and last sample (optional, the whole run by default)
+    ---
+    output:
+        data of the modality's channels, ordered as in the channel groups
+    """
 
-            data = run.get_data(picks=group_channels, units="fT")
+    rows = numpy.array([store["positions"][name] for name in groups["names"]])
+    if numpy.all(numpy.diff(rows) == 1):
+        return store["data"][rows[0] : rows[-1] + 1, start:stop]
 
-            # Store psd
-            meg_groups_psd[group_name] = signal.welch(data, sfreq)
+    return store["data"][rows, start:stop]
 
-            # Store mean
-            meg_groups_data[group_name] = numpy.mean(data, axis=0)
 
-        meg_groups_data_per_run.append(meg_groups_data)
-        meg_groups_psd_per_run.append(meg_groups_psd)
+# ----
+# Level of detail
+# ----
 
-        # Get events from downsampled version
-        events_per_run.append(extract_events(run))
+# Pyramid levels are this many times shorter than the previous one,
+# levels are added until they are shorter than the minimum length (in samples)
+pyramid_factor = 4
+pyramid_minimum = 1024
 
-    # Return collected data
-    return (
-        eeg_groups_data_per_run,
-        eeg_groups_psd_per_run,
-        meg_groups_data_per_run,
-        meg_groups_psd_per_run,
-        events_per_run,
-    )
 
+def pyramid_levels(data, factor=pyramid_factor, level=0):
+    """
+    Reduces a signal to levels of per bucket minimum, maximum and mean,
+    each level with buckets that are factor times larger than the previous one
+    ---
+    input:
+        signal (or channels x samples)
+        decimation factor between levels
+        level of the signal, when it already has a value per bucket of a level (e.g. 1 for a value per factor samples)
+    ---
+    output:
+        list of levels (minimum, maximum, mean), the level of the signal being the signal itself
+        (the finer levels are None)
+    """
 
-def extract_events(run, selection=None):
+    levels = [None] * level + [(data, data, data)]
+    minimum, maximum, mean = levels[level]
+    counts = numpy.ones(data.shape[-1])
+    while len(counts) > pyramid_minimum:
+        # Every level is computed from the previous one, the last bucket may be shorter
+        starts = numpy.arange(0, len(counts), factor)
+        sums = numpy.add.reduceat(mean * counts, starts, axis=-1)
+        counts = numpy.add.reduceat(counts, starts)
+        minimum = numpy.minimum.reduceat(minimum, starts, axis=-1)
+        maximum = numpy.maximum.reduceat(maximum, starts, axis=-1)
+        mean = (sums / counts).astype(data.dtype)
+        levels.append((minimum, maximum, mean))
 
-    # Get events
-    events, _ = mne.events_from_annotations(run)
+    return levels
 
-    # Get event ids
-    selected_ids = selection if selection is not None else list(range(1, 4))
 
-    # Transform
-    transformed_events = []
-    for event in events:
-        if event[2] in selected_ids:
-            transformed_events.append([event[0], event[2]])
+def load_levels(subject, run, EEG_groups, MEG_groups, EEG_avgs, MEG_avgs):
+    """
+    Returns the pyramid levels of the group averages of a subject's run, computed only once per server process
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        EEG channel groups
+        MEG channel groups
+        dict of EEG run average per group
+        dict of MEG run average per group
+    ---
+    output:
+        dict of EEG pyramid levels per group
+        dict of MEG pyramid levels per group
+    """
 
-    return numpy.array(transformed_events)
+    def compute():
+        return (
+            {group_name: pyramid_levels(group_avg) for group_name, group_avg in EEG_avgs.items()},
+            {group_name: pyramid_levels(group_avg) for group_name, group_avg in MEG_avgs.items()},
+        )
 
+    return cached(
+        ("levels", subject, run, EEG_groups["key"], MEG_groups["key"]), compute
+    )
 
-# -----
-# Windows
-# -----
-def avg_windows(
-    runs, event_selection, tmin, tmax, EEG_groups_assignment, MEG_groups_assignment
+
+def pyramid_base(levels, factor=pyramid_factor):
+    """
+    Returns the finest level of a pyramid (see pyramid_levels) and the number of samples it spans
+    (rounded up to whole buckets of the finest level)
+    """
+    base = next(level for level, buckets in enumerate(levels) if buckets is not None)
+    return base, len(levels[base][0]) * factor**base
+
+
+def load_band_levels(
+    subject, run, band, EEG_groups, MEG_groups, EEG_envelopes, MEG_envelopes
 ):
     """
-    Parses and returns average window for a given subject
+    Returns the pyramid levels of the group envelopes of a frequency band of a subject's run,
+    the envelopes being its first level (see group_band_envelopes), computed only once per server process
     ---
     input:
-        raw runs
-        list of event ids to window over
-        time to cut before the event (must be >= minimum_min)
-        time to cut after the event  (must be <= maximum_max)
-        EEG group assignments
-        MEG group assignments
+        subject number [1-16]
+        run number [1-6]
+        frequency band
+        EEG channel groups
+        MEG channel groups
+        dict of EEG envelope per group
+        dict of MEG envelope per group
     ---
-    output
-        dict of EEG runs windowed average per group
-        dict of EEG psd windowed average per group
-        dict of MEG runs windowed average per group
-        dict of MEG psd windowed average per group
+    output:
+        dict of EEG pyramid levels per group
+        dict of MEG pyramid levels per group
     """
 
-    # Window
-    dev_head_t = runs[0].info["dev_head_t"]
-    epochs = []
-    for run in runs:
-        run.info["dev_head_t"] = dev_head_t
-        epochs.append(
-            mne.Epochs(
-                run,
-                numpy.insert(extract_events(run, event_selection), 1, 0, axis=1),
-                tmin=tmin,
-                tmax=tmax,
-                preload=True,
-            )
-        )
-    windows = mne.concatenate_epochs(epochs)
-
-    # Split per EEG group
-    eeg_groups_windows = {}
-    eeg_groups_psd = {}
-    for group_name, group_channels in EEG_groups_assignment.items():
-        avg_window = numpy.mean(
-            windows.get_data(picks=group_channels, units="uV"), axis=0
-        )
-        eeg_groups_windows[group_name] = numpy.mean(
-            avg_window,
-            axis=0,
+    def compute():
+        return (
+            {group_name: pyramid_levels(envelope, level=1) for group_name, envelope in EEG_envelopes.items()},
+            {group_name: pyramid_levels(envelope, level=1) for group_name, envelope in MEG_envelopes.items()},
         )
-        eeg_groups_psd[group_name] = signal.welch(avg_window, 145)
-
-    # Split per MEG group
-    meg_groups_windows = {}
-    meg_groups_psd = {}
-    for group_name, group_channels in MEG_groups_assignment.items():
-        avg_window = numpy.mean(
-            windows.get_data(picks=group_channels, units="fT"), axis=0
-        )
-        meg_groups_windows[group_name] = numpy.mean(
-            avg_window,
-            axis=0,
-        )
-        meg_groups_psd[group_name] = signal.welch(avg_window, 145)
 
-    return eeg_groups_windows, eeg_groups_psd, meg_groups_windows, meg_groups_psd
+    return cached(
+        ("band levels", subject, run, band, EEG_groups["key"], MEG_groups["key"]),
+        compute,
+    )
+
+
+def choose_level(start, stop, columns, levels, factor=pyramid_factor):
+    """
+    Returns the coarsest pyramid level that still has a bucket for every column of a range
+    ---
+    input:
+        first sample of the range
+        last sample of the range (exclusive)
+        number of columns the range is drawn on
+        number of levels above full resolution
+        decimation factor between levels
+    ---
+    output:
+        level (0 is full resolution)
+    """
+
+    level = 0
+    while level < levels and (stop - start) / factor ** (level + 1) >= columns:
+        level += 1
+
+    return level
+
+
+def envelope(levels, start, stop, columns, factor=pyramid_factor):
+    """
+    Reduces a range of a signal to a min/max envelope from the coarsest pyramid level that fills the columns,
+    ranges that are short enough are returned at the finest level (a value per bucket, at the middle of the bucket)
+    ---
+    input:
+        pyramid levels of the signal (see pyramid_levels)
+        first sample of the range
+        last sample of the range (exclusive)
+        number of columns to draw the range on
+        decimation factor between levels
+    ---
+    output:
+        sample positions
+        signal values at those positions
+    """
+
+    base, length = pyramid_base(levels, factor)
+    start = max(0, int(start))
+    stop = min(length, int(stop))
+    level = max(base, choose_level(start, stop, columns, len(levels) - 1, factor))
+    if level == base:
+        data = levels[base][0]
+        size = factor**base
+        first = start // size
+        last = min(len(data), math.ceil(stop / size))
+        positions = numpy.arange(first, last) * size + (size - 1) / 2
+        return positions, data[first:last]
+
+    # Minimum and maximum of every bucket, drawn at the middle of the bucket
+    # (buckets are aligned to multiples of their size so panning does not change their content)
+    minimum, maximum, _ = levels[level]
+    size = factor**level
+    first = start // size
+    last = min(len(minimum), math.ceil(stop / size))
+    positions = numpy.repeat(numpy.arange(first, last) * size + (size - 1) / 2, 2)
+    values = numpy.stack([minimum[first:last], maximum[first:last]], axis=1).ravel()
+
+    return positions, values
+
+
+# ----
+# Channel groups
+# ----
+def channel_groups(channel_names, groups_assignment):
+    """
+    Precomputes the channel indices and averaging weights of each group of a modality
+    ---
+    input:
+        channel names of the modality
+        group assignments
+    ---
+    output:
+        dict with the channel names, the indices of each group's channels in those names,
+        a matrix that averages the channels of each group (one row per group)
+        and a key that identifies the grouping in caches
+    """
+
+    positions = {channel_name: idx for idx, channel_name in enumerate(channel_names)}
+    indices = {}
+    weights = numpy.zeros((len(groups_assignment), len(channel_names)))
+    for group_idx, (group_name, group_channels) in enumerate(groups_assignment.items()):
+        assert len(group_channels) > 0
+
+        indices[group_name] = numpy.array(
+            [positions[channel_name] for channel_name in group_channels]
+        )
+        weights[group_idx, indices[group_name]] = 1 / len(group_channels)
+
+    return {
+        "names": list(channel_names),
+        "indices": indices,
+        "weights": weights,
+        "key": tuple(
+            (group_name, tuple(group_channels))
+            for group_name, group_channels in groups_assignment.items()
+        ),
+    }
+
+
+def group_means(data, groups):
+    """
+    Reduces the data of a modality to group averages
+    ---
+    input:
+        data of the modality's channels, ordered as in the channel groups
+        channel groups
+    ---
+    output:
+        dict of average per group
+    """
+
+    # Weights in the data's precision so float32 stores are not converted first
+    means = groups["weights"].astype(data.dtype, copy=False) @ data
+
+    return {
+        group_name: means[group_idx]
+        for group_idx, group_name in enumerate(groups["indices"].keys())
+    }
+
+
+def group_psds(data, groups):
+    """
+    Computes the per channel Welch spectra of a modality, split per group
+    ---
+    input:
+        data of the modality's channels, ordered as in the channel groups
+        channel groups
+    ---
+    output:
+        dict of psd per group
+    """
+
+    freqs, psds = signal.welch(data, sfreq)
+
+    return {
+        group_name: (freqs, psds[group_indices])
+        for group_name, group_indices in groups["indices"].items()
+    }
+
+
+@lru_cache(maxsize=None)
+def spectrogram_taper(window):
+    """
+    Returns the Hann taper of a segment length and the scale of its power spectral density,
+    the same for every chunk (as is scipy's plan of the transform of that length)
+    """
+    taper = signal.windows.hann(window, sym=False)
+    return taper, 1 / (sfreq * numpy.sum(numpy.square(taper)))
+
+
+def group_spectrograms(data, groups, window, step):
+    """
+    Computes the spectrograms of a modality's channels a chunk of segments at a time and averages them per group
+    ---
+    input:
+        data of the modality's channels, ordered as in the channel groups
+        channel groups
+        samples per segment (at most the length of the data)
+        samples between segments
+    ---
+    output:
+        dict of spectrogram per group (segment centre times (s), frequencies (Hz), power (dB) per frequency and segment)
+    """
+
+    window = min(window, data.shape[-1])
+    taper, scale = spectrogram_taper(window)
+    segments = numpy.lib.stride_tricks.sliding_window_view(data, window, axis=-1)[:, ::step]
+
+    power = numpy.empty((len(groups["indices"]), window // 2 + 1, segments.shape[1]))
+    for chunk_start in range(0, segments.shape[1], spectrogram_chunk):
+        chunk = segments[:, chunk_start : chunk_start + spectrogram_chunk]
+        spectra = numpy.square(numpy.abs(fft.rfft(chunk * taper, axis=-1))) * scale
+        spectra[..., 1 : (window + 1) // 2] *= 2
+        power[:, :, chunk_start : chunk_start + spectrogram_chunk] = numpy.einsum(
+            "gc,csf->gfs", groups["weights"], spectra
+        )
+
+    times = ((numpy.arange(segments.shape[1]) * step + window / 2) / sfreq).astype(numpy.float32)
+    freqs = fft.rfftfreq(window, 1 / sfreq).astype(numpy.float32)
+    power = (10 * numpy.log10(power + numpy.finfo(numpy.float32).tiny)).astype(numpy.float32)
+    return {
+        group_name: (times, freqs, group_power)
+        for group_name, group_power in zip(groups["indices"].keys(), power)
+    }
+
+
+@lru_cache(maxsize=None)
+def band_filter(band):
+    """
+    Returns the band-pass filter of a frequency band as second order sections, designed once per band
+    """
+    return signal.butter(
+        band_order, frequency_bands[band], btype="bandpass", fs=sfreq, output="sos"
+    )
+
+
+def group_band_envelopes(data, groups, factor=pyramid_factor):
+    """
+    Computes the amplitude envelopes (zero phase band-pass and Hilbert magnitude) of the channels of a modality
+    for every frequency band and averages them per group, at the rate of the first pyramid level
+    ---
+    input:
+        data of the modality's channels, ordered as in the channel groups
+        channel groups
+        decimation factor
+    ---
+    output:
+        dict per band of dict of envelope per group (in the unit of the data, see pyramid_levels to show them)
+    """
+
+    length = data.shape[-1]
+    starts = numpy.arange(0, length, factor)
+    counts = numpy.diff(numpy.append(starts, length))
+
+    envelopes = {}
+    for band in frequency_bands.keys():
+        # Every channel is filtered once, a chunk of channels at a time so memory does not grow with the channels
+        group_envelopes = 0
+        for chunk_start in range(0, data.shape[0], band_chunk):
+            chunk = slice(chunk_start, chunk_start + band_chunk)
+            filtered = signal.sosfiltfilt(band_filter(band), data[chunk], axis=-1)
+            amplitude = numpy.abs(
+                signal.hilbert(filtered, fft.next_fast_len(length), axis=-1)[:, :length]
+            )
+            group_envelopes = group_envelopes + groups["weights"][:, chunk] @ amplitude
+        envelopes[band] = dict(
+            zip(
+                groups["indices"].keys(),
+                (numpy.add.reduceat(group_envelopes, starts, axis=-1) / counts).astype(
+                    numpy.float32
+                ),
+            )
+        )
+
+    return envelopes
+
+
+def group_reductions(data, groups):
+    """
+    Reduces the data of a modality to group averages and per channel Welch spectra per group
+    ---
+    input:
+        data of the modality's channels, ordered as in the channel groups
+        channel groups
+    ---
+    output:
+        dict of average per group
+        dict of psd per group
+    """
+
+    return group_means(data, groups), group_psds(data, groups)
+
+
+# ----
+# Group averages
+# ----
+def run_data(run, EEG_groups, MEG_groups):
+    """
+    Reads the EEG and MEG data of a run, each with one call
+    ---
+    input:
+        raw run
+        EEG channel groups
+        MEG channel groups
+    ---
+    output:
+        EEG data (µV), ordered as in the EEG channel groups
+        MEG data (fT), ordered as in the MEG channel groups
+    """
+
+    return (
+        run.get_data(picks=EEG_groups["names"], units="uV"),
+        run.get_data(picks=MEG_groups["names"], units="fT"),
+    )
+
+
+def load_time_domain(subject, run, EEG_groups, MEG_groups, read_data):
+    """
+    Returns the group averages and events of a subject's run,
+    from the memory or disk cache when they were computed before
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        EEG channel groups
+        MEG channel groups
+        function that returns the events of the run and its data (see run_reader)
+    ---
+    output:
+        dict of EEG run average per group
+        dict of MEG run average per group
+        events
+    """
+
+    def compute():
+        events, eeg_data, meg_data = read_data()
+        return (
+            group_means(eeg_data, EEG_groups),
+            group_means(meg_data, MEG_groups),
+            events,
+        )
+
+    params = (subject, run, EEG_groups["key"], MEG_groups["key"])
+    return cached(
+        ("time domain",) + params,
+        partial(disk_cached, "time_domain", run_sources(subject, run), params, compute),
+    )
+
+
+def load_frequency_domain(subject, run, EEG_groups, MEG_groups, read_data):
+    """
+    Returns the group psds of a subject's run,
+    from the memory or disk cache when they were computed before
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        EEG channel groups
+        MEG channel groups
+        function that returns the events of the run and its data (see run_reader)
+    ---
+    output:
+        dict of EEG psd per group
+        dict of MEG psd per group
+    """
+
+    def compute():
+        _, eeg_data, meg_data = read_data()
+        return group_psds(eeg_data, EEG_groups), group_psds(meg_data, MEG_groups)
+
+    params = (subject, run, EEG_groups["key"], MEG_groups["key"])
+    return cached(
+        ("frequency domain",) + params,
+        partial(
+            disk_cached, "frequency_domain", run_sources(subject, run), params, compute
+        ),
+    )
+
+
+def load_spectrogram(subject, run, EEG_groups, MEG_groups, read_data):
+    """
+    Returns the group spectrograms of a subject's run,
+    from the memory or disk cache when they were computed before
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        EEG channel groups
+        MEG channel groups
+        function that returns the events of the run and its data (see run_reader)
+    ---
+    output:
+        dict of EEG spectrogram per group
+        dict of MEG spectrogram per group
+    """
+
+    def compute():
+        _, eeg_data, meg_data = read_data()
+        return (
+            group_spectrograms(eeg_data, EEG_groups, spectrogram_window, spectrogram_step),
+            group_spectrograms(meg_data, MEG_groups, spectrogram_window, spectrogram_step),
+        )
+
+    params = (
+        subject,
+        run,
+        EEG_groups["key"],
+        MEG_groups["key"],
+        spectrogram_window,
+        spectrogram_step,
+    )
+    return cached(
+        ("spectrogram",) + params,
+        partial(disk_cached, "spectrogram", run_sources(subject, run), params, compute),
+    )
+
+
+def load_band_envelopes(subject, run, EEG_groups, MEG_groups, read_data):
+    """
+    Returns the group envelopes of the frequency bands of a subject's run,
+    from the memory or disk cache when they were computed before
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        EEG channel groups
+        MEG channel groups
+        function that returns the events of the run and its data (see run_reader)
+    ---
+    output:
+        dict per band of dict of EEG envelope per group
+        dict per band of dict of MEG envelope per group
+    """
+
+    def compute():
+        _, eeg_data, meg_data = read_data()
+        return (
+            group_band_envelopes(eeg_data, EEG_groups),
+            group_band_envelopes(meg_data, MEG_groups),
+        )
+
+    params = (
+        subject,
+        run,
+        EEG_groups["key"],
+        MEG_groups["key"],
+        tuple(frequency_bands.items()),
+        band_order,
+        pyramid_factor,
+    )
+    return cached(
+        ("band envelopes",) + params,
+        partial(
+            disk_cached, "band_envelopes", run_sources(subject, run), params, compute
+        ),
+    )
+
+
+def extract_events(run, selection=None):
+
+    # Get events
+    events, _ = mne.events_from_annotations(run)
+
+    # Get event ids
+    selected_ids = selection if selection is not None else list(range(1, 4))
+
+    # Transform
+    selected = numpy.isin(events[:, 2], selected_ids)
+
+    return events[selected][:, [0, 2]]
+
+
+def index_events(events):
+    """
+    Indexes the events of a run per event type
+    ---
+    input:
+        events (sample, event id)
+    ---
+    output:
+        dict with all events and the samples of the events per event id
+    """
+
+    return {
+        "events": events,
+        "samples": {
+            event_id: events[events[:, 1] == event_id, 0]
+            for event_id in range(1, len(event_names) + 1)
+        },
+    }
+
+
+def load_events(subject, run):
+    """
+    Returns the indexed events of a subject's run (see index_events), parsed only once per server process,
+    from the store when the run has one and from the annotations otherwise
+    """
+
+    def compute():
+        if os.path.exists(run_path(subject, run, "processed.npy")):
+            return index_events(load_store(subject, run)["events"])
+        return index_events(extract_events(load_run(subject, run)))
+
+    return cached(("events", subject, run), compute)
+
+
+# -----
+# Windows
+# -----
+def group_signals(data, EEG_rows, MEG_rows, EEG_groups, MEG_groups):
+    """
+    Reduces epochs to their group averages (not baseline corrected, that depends on the window)
+    ---
+    input:
+        data of one or more epochs (... x channels x samples)
+        rows of the EEG channels in the data, ordered as in the EEG channel groups
+        rows of the MEG channels in the data, ordered as in the MEG channel groups
+        EEG channel groups
+        MEG channel groups
+    ---
+    output:
+        group averages (... x groups x samples), EEG groups (µV) followed by MEG groups (fT)
+    """
+
+    return numpy.concatenate(
+        [
+            EEG_groups["weights"] @ (1e6 * data[..., EEG_rows, :]),
+            MEG_groups["weights"] @ (1e15 * data[..., MEG_rows, :]),
+        ],
+        axis=-2,
+    )
+
+
+def event_room(run, events):
+    """
+    Returns how far the run reaches around each event, in samples relative to the event,
+    and which events have room for the widest window
+    """
+    start = int(round(-minimum_min * sfreq))
+    stop = int(round(maximum_max * sfreq))
+    lowest = run.first_samp - events[:, 0]
+    highest = run.last_samp - events[:, 0]
+    return lowest, highest, (lowest <= start) & (highest >= stop)
+
+
+def widest_epochs(run, events):
+    """
+    Reads the epochs of a run's events with room for the widest window (see event_room) at the widest window,
+    a few epochs at a time so memory does not grow with the number of events
+    ---
+    input:
+        raw run
+        events of the run
+    ---
+    output:
+        generator of the event ids and data (epochs x channels x samples) per chunk of epochs
+    """
+
+    start = int(round(-minimum_min * sfreq))
+    stop = int(round(maximum_max * sfreq))
+    inside = event_room(run, events)[2]
+    if not numpy.any(inside):
+        return
+    epochs = mne.Epochs(
+        run,
+        numpy.insert(events[inside], 1, 0, axis=1),
+        tmin=start / sfreq,
+        tmax=stop / sfreq,
+        baseline=None,
+        preload=False,
+    )
+
+    for chunk_start in range(0, len(epochs.events), epoch_chunk):
+        chunk = epochs[chunk_start : chunk_start + epoch_chunk]
+        yield chunk.events[:, 2], chunk.get_data()
+
+
+def window_sums(runs, EEG_groups, MEG_groups, run_events=None):
+    """
+    Epochs each run once at the widest legal window and sums the epochs per event type,
+    so that average windows can be derived for any window and event selection
+    ---
+    input:
+        raw runs
+        EEG channel groups
+        MEG channel groups
+        events of each run (extracted from the runs if not given)
+    ---
+    output:
+        dict with the channel names, the first sample offset of the window,
+        the summed epochs and epoch counts per event id, the group averages of the epochs per event id
+        (for the spread over the epochs, which depends on the baseline of the window)
+        and the epochs of events that are too close to the start or end of their run for the widest window
+    """
+
+    # Widest window in samples relative to the event
+    start = int(round(-minimum_min * sfreq))
+    stop = int(round(maximum_max * sfreq))
+
+    ch_names = runs[0].ch_names
+    event_ids = list(range(1, len(event_names) + 1))
+    sums = {
+        event_id: numpy.zeros((len(ch_names), stop - start + 1))
+        for event_id in event_ids
+    }
+
+    # Group averages of the epochs are kept (a few groups per epoch rather than all channels)
+    positions = {channel_name: idx for idx, channel_name in enumerate(ch_names)}
+    EEG_rows = [positions[channel_name] for channel_name in EEG_groups["names"]]
+    MEG_rows = [positions[channel_name] for channel_name in MEG_groups["names"]]
+    n_groups = len(EEG_groups["indices"]) + len(MEG_groups["indices"])
+    group_epochs = {
+        event_id: [numpy.zeros((0, n_groups, stop - start + 1), dtype=numpy.float32)]
+        for event_id in event_ids
+    }
+    counts = {event_id: 0 for event_id in event_ids}
+    edges = []
+    for run_idx, run in enumerate(runs):
+        events = run_events[run_idx] if run_events is not None else extract_events(run)
+
+        # Epochs that do not fit within the run are dropped by mne,
+        # so only events with room for the widest window can be summed
+        lowest, highest, inside = event_room(run, events)
+        for chunk_events, data in widest_epochs(run, events):
+            signals = group_signals(data, EEG_rows, MEG_rows, EEG_groups, MEG_groups)
+            for event_id in event_ids:
+                selected = chunk_events == event_id
+                sums[event_id] += numpy.sum(data[selected], axis=0)
+                group_epochs[event_id].append(signals[selected].astype(numpy.float32))
+                counts[event_id] += int(numpy.count_nonzero(selected))
+
+        # Events near the edges of the run are kept with as much data as is available
+        for event, event_lowest, event_highest in zip(
+            events[~inside], lowest[~inside], highest[~inside]
+        ):
+            edge_start = max(start, event_lowest)
+            edge_stop = min(stop, event_highest)
+            edge_epochs = mne.Epochs(
+                run,
+                numpy.array([[event[0], 0, event[1]]]),
+                tmin=edge_start / sfreq,
+                tmax=edge_stop / sfreq,
+                baseline=None,
+                preload=True,
+            )
+            edges.append(
+                {
+                    "event_id": event[1],
+                    "start": edge_start,
+                    "stop": edge_stop,
+                    "data": edge_epochs.get_data()[0],
+                }
+            )
+
+    return {
+        "ch_names": ch_names,
+        "start": start,
+        "sums": sums,
+        "counts": counts,
+        "group_keys": (EEG_groups["key"], MEG_groups["key"]),
+        "group_epochs": {
+            event_id: numpy.concatenate(event_group_epochs)
+            for event_id, event_group_epochs in group_epochs.items()
+        },
+        "edges": edges,
+    }
+
+
+def load_window_sums(subject):
+    """
+    Returns the window sums of all of a subject's runs,
+    from the memory or disk cache when they were computed before
+    (the spread is accumulated for the channel groups of the metadata)
+    """
+    metadata = load_metadata()
+    EEG_groups = metadata["eeg_groups"]
+    MEG_groups = metadata["meg_groups"]
+    params = (
+        subject,
+        minimum_min,
+        maximum_max,
+        sfreq,
+        EEG_groups["key"],
+        MEG_groups["key"],
+        window_sums_layout,
+    )
+    return cached(
+        ("window sums", subject),
+        partial(
+            disk_cached,
+            "window_sums",
+            [source for run in range(1, 7) for source in run_sources(subject, run)],
+            params,
+            lambda: window_sums(
+                [load_run(subject, run) for run in range(1, 7)],
+                EEG_groups,
+                MEG_groups,
+                [load_events(subject, run)["events"] for run in range(1, 7)],
+            ),
+        ),
+    )
+
+
+def window_epochs(subject, run, event_selection, start, stop, EEG_groups, MEG_groups):
+    """
+    Reads the epochs of the selected events of a subject's run that have room for a window, a few at a time,
+    from the memory-mapped store when the run has one and from the raw run otherwise
+    ---
+    input:
+        subject number [1-16]
+        run number [1-6]
+        list of event ids to window over
+        first sample of the window relative to the event
+        last sample of the window relative to the event
+        EEG channel groups
+        MEG channel groups
+    ---
+    output:
+        generator of the EEG data (µV) and MEG data (fT) per chunk of epochs (epochs x channels x samples),
+        ordered as in the channel groups
+    """
+
+    if os.path.exists(run_path(subject, run, "processed.npy")):
+        store = load_store(subject, run)
+        samples = store["events"][numpy.isin(store["events"][:, 1], event_selection), 0]
+        samples = samples - store["first_samp"]
+        samples = samples[(samples + start >= 0) & (samples + stop < store["data"].shape[1])]
+        for chunk_start in range(0, len(samples), epoch_chunk):
+            chunk = samples[chunk_start : chunk_start + epoch_chunk]
+            yield (
+                numpy.stack(
+                    [store_data(store, EEG_groups, sample + start, sample + stop + 1) for sample in chunk]
+                ),
+                numpy.stack(
+                    [store_data(store, MEG_groups, sample + start, sample + stop + 1) for sample in chunk]
+                ),
+            )
+        return
+
+    raw = load_run(subject, run)
+    events = load_events(subject, run)["events"]
+    lowest, highest, _ = event_room(raw, events)
+    selected = numpy.isin(events[:, 1], event_selection) & (lowest <= start) & (highest >= stop)
+    if not numpy.any(selected):
+        return
+    epochs = mne.Epochs(
+        raw,
+        numpy.insert(events[selected], 1, 0, axis=1),
+        tmin=start / sfreq,
+        tmax=stop / sfreq,
+        baseline=None,
+        preload=False,
+    )
+    for chunk_start in range(0, len(epochs.events), epoch_chunk):
+        chunk = epochs[chunk_start : chunk_start + epoch_chunk]
+        yield (
+            chunk.get_data(picks=EEG_groups["names"], units="uV"),
+            chunk.get_data(picks=MEG_groups["names"], units="fT"),
+        )
+
+
+def epoch_psds(subject, event_selection, tmin, tmax, EEG_groups, MEG_groups):
+    """
+    Averages the per channel Welch spectra of the single epochs of a window over all of a subject's runs
+    (so of the power of the single epochs, whether it is locked to the events or not),
+    with the same segments as the spectra of the average window (see group_psds)
+    ---
+    input:
+        subject number [1-16]
+        list of event ids to window over
+        time to cut before the event (must be >= minimum_min)
+        time to cut after the event  (must be <= maximum_max)
+        EEG channel groups
+        MEG channel groups
+    ---
+    output:
+        dict of EEG psd per group
+        dict of MEG psd per group
+    """
+
+    # Window in samples relative to the event, segments as Welch's default for the average window
+    start = int(round(tmin * sfreq))
+    stop = int(round(tmax * sfreq))
+    nperseg = min(256, stop - start + 1)
+
+    eeg_total = 0
+    meg_total = 0
+    count = 0
+    for run in range(1, 7):
+        for eeg_data, meg_data in window_epochs(
+            subject, run, event_selection, start, stop, EEG_groups, MEG_groups
+        ):
+            freqs, eeg_psds = signal.welch(eeg_data, sfreq, nperseg=nperseg)
+            _, meg_psds = signal.welch(meg_data, sfreq, nperseg=nperseg)
+            eeg_total = eeg_total + numpy.sum(eeg_psds, axis=0, dtype=numpy.float64)
+            meg_total = meg_total + numpy.sum(meg_psds, axis=0, dtype=numpy.float64)
+            count += len(eeg_data)
+
+    return (
+        {
+            group_name: (freqs, eeg_total[group_indices] / count)
+            for group_name, group_indices in EEG_groups["indices"].items()
+        },
+        {
+            group_name: (freqs, meg_total[group_indices] / count)
+            for group_name, group_indices in MEG_groups["indices"].items()
+        },
+    )
+
+
+def load_epoch_psds(subject, event_selection, tmin, tmax):
+    """
+    Returns the spectra of the single epochs of a window of a subject (see epoch_psds),
+    computed only once per server process (for the channel groups of the metadata)
+    """
+    metadata = load_metadata()
+    return cached(
+        (("epoch psds", tuple(event_selection), tmin, tmax), subject),
+        partial(
+            epoch_psds,
+            subject,
+            event_selection,
+            tmin,
+            tmax,
+            metadata["eeg_groups"],
+            metadata["meg_groups"],
+        ),
+    )
+
+
+def avg_windows(
+    window_sums,
+    event_selection,
+    tmin,
+    tmax,
+    EEG_groups,
+    MEG_groups,
+    window_epoch_psds=None,
+):
+    """
+    Parses and returns average window for a given subject
+    ---
+    input:
+        window sums of the subject's raw runs
+        list of event ids to window over
+        time to cut before the event (must be >= minimum_min)
+        time to cut after the event  (must be <= maximum_max)
+        EEG channel groups
+        MEG channel groups
+        spectra of the single epochs of the window (see epoch_psds), if given they are the psds
+        rather than the spectra of the average window
+    ---
+    output
+        dict of EEG runs windowed average per group
+        dict of EEG psd windowed average per group
+        dict of MEG runs windowed average per group
+        dict of MEG psd windowed average per group
+        dict of EEG standard error of the windowed average per group
+        dict of MEG standard error of the windowed average per group
+        dict of EEG spectrogram of the windowed average per group
+        dict of MEG spectrogram of the windowed average per group
+    """
+
+    # Window in samples relative to the event
+    start = int(round(tmin * sfreq))
+    stop = int(round(tmax * sfreq))
+    offset = start - window_sums["start"]
+    assert window_sums["group_keys"] == (EEG_groups["key"], MEG_groups["key"])
+    positions = {
+        channel_name: idx for idx, channel_name in enumerate(window_sums["ch_names"])
+    }
+
+    # Sum the selected epochs, and gather their group averages
+    total = 0
+    group_epochs = []
+    count = 0
+    for event_id in event_selection:
+        total = (
+            total
+            + window_sums["sums"][event_id][:, offset : offset + stop - start + 1]
+        )
+        group_epochs.append(
+            window_sums["group_epochs"][event_id][:, :, offset : offset + stop - start + 1]
+        )
+        count += window_sums["counts"][event_id]
+    for edge in window_sums["edges"]:
+        if (
+            edge["event_id"] in event_selection
+            and edge["start"] <= start
+            and edge["stop"] >= stop
+        ):
+            edge_offset = start - edge["start"]
+            edge_window = edge["data"][:, edge_offset : edge_offset + stop - start + 1]
+            total = total + edge_window
+            group_epochs.append(
+                group_signals(
+                    edge_window[numpy.newaxis],
+                    [positions[channel_name] for channel_name in EEG_groups["names"]],
+                    [positions[channel_name] for channel_name in MEG_groups["names"]],
+                    EEG_groups,
+                    MEG_groups,
+                ).astype(numpy.float32)
+            )
+            count += 1
+
+    # Standard error of the mean over the epochs, each corrected with its baseline up to the event
+    # as the average below is (so it is the spread of the plotted average)
+    group_epochs = numpy.concatenate(group_epochs)
+    group_epochs -= numpy.mean(group_epochs[:, :, : -start + 1], axis=-1, keepdims=True)
+    if count > 1:
+        errors = numpy.std(group_epochs, axis=0, ddof=1, dtype=numpy.float64) / numpy.sqrt(count)
+    else:
+        errors = numpy.zeros(group_epochs.shape[1:])
+    eeg_groups_errors = dict(zip(EEG_groups["indices"].keys(), errors))
+    meg_groups_errors = dict(
+        zip(MEG_groups["indices"].keys(), errors[len(EEG_groups["indices"]) :])
+    )
+
+    # Average and correct with the baseline up to the event (as mne.Epochs does by default)
+    avg_window = total / count
+    avg_window = avg_window - numpy.mean(
+        avg_window[:, : -start + 1], axis=1, keepdims=True
+    )
+
+    # Split per group
+    eeg_window = 1e6 * avg_window[[positions[channel_name] for channel_name in EEG_groups["names"]]]
+    meg_window = 1e15 * avg_window[[positions[channel_name] for channel_name in MEG_groups["names"]]]
+    eeg_groups_windows, eeg_groups_psd = group_reductions(eeg_window, EEG_groups)
+    meg_groups_windows, meg_groups_psd = group_reductions(meg_window, MEG_groups)
+
+    # Spectra of the epochs
+    if window_epoch_psds is not None:
+        eeg_groups_psd, meg_groups_psd = window_epoch_psds
+
+    # Spectrograms of the average window (so of the activity locked to the events)
+    eeg_groups_spectrogram = group_spectrograms(
+        eeg_window, EEG_groups, window_spectrogram_window, window_spectrogram_step
+    )
+    meg_groups_spectrogram = group_spectrograms(
+        meg_window, MEG_groups, window_spectrogram_window, window_spectrogram_step
+    )
+
+    return (
+        eeg_groups_windows,
+        eeg_groups_psd,
+        meg_groups_windows,
+        meg_groups_psd,
+        eeg_groups_errors,
+        meg_groups_errors,
+        eeg_groups_spectrogram,
+        meg_groups_spectrogram,
+    )
+
+
+def load_windows(
+    subject,
+    window_sums,
+    event_selection,
+    tmin,
+    tmax,
+    EEG_groups,
+    MEG_groups,
+    window_epoch_psds=None,
+):
+    """
+    Returns the average windows of a subject (see avg_windows), computed only once per server process
+    """
+    return cached(
+        (
+            "windows",
+            subject,
+            tuple(event_selection),
+            tmin,
+            tmax,
+            EEG_groups["key"],
+            MEG_groups["key"],
+            window_epoch_psds is not None,
+        ),
+        partial(
+            avg_windows,
+            window_sums,
+            event_selection,
+            tmin,
+            tmax,
+            EEG_groups,
+            MEG_groups,
+            window_epoch_psds,
+        ),
+    )
+
+
+# -----
+# Grand average
+# -----
+def subjects_sums(subjects, name, load):
+    """
+    Starts loading results of several subjects without waiting for them (map),
+    the ones that are neither cached nor being computed by a session are computed in parallel by the worker processes
+    ---
+    input:
+        subject numbers
+        name of the results, as cached by the function that loads them (e.g. "window sums")
+        function that loads the results of a subject (e.g. load_window_sums)
+    ---
+    output:
+        dict of future of the results per subject
+    """
+
+    return {
+        subject: cached_future(
+            (name, subject),
+            partial(submit_process, load, subject),
+        )
+        for subject in subjects
+    }
+
+
+def grand_average(
+    subject_sums,
+    event_selection,
+    tmin,
+    tmax,
+    EEG_groups,
+    MEG_groups,
+    subject_epoch_psds=None,
+):
+    """
+    Averages the average windows of several subjects (reduce), each subject weighing the same,
+    the standard errors are those of the grand average over the subjects
+    ---
+    input:
+        dict of window sums per subject (see subjects_sums)
+        list of event ids to window over
+        time to cut before the event (must be >= minimum_min)
+        time to cut after the event  (must be <= maximum_max)
+        EEG channel groups
+        MEG channel groups
+        dict of spectra of the single epochs of the window per subject (see epoch_psds), if given they are the psds
+    ---
+    output
+        dict of EEG windowed grand average per group
+        dict of EEG psd windowed grand average per group
+        dict of MEG windowed grand average per group
+        dict of MEG psd windowed grand average per group
+        dict of EEG standard error of the windowed grand average per group
+        dict of MEG standard error of the windowed grand average per group
+        dict of EEG spectrogram of the windowed grand average per group
+        dict of MEG spectrogram of the windowed grand average per group
+    """
+
+    subject_windows = [
+        load_windows(
+            subject,
+            subject_sums[subject],
+            event_selection,
+            tmin,
+            tmax,
+            EEG_groups,
+            MEG_groups,
+            subject_epoch_psds[subject] if subject_epoch_psds is not None else None,
+        )
+        for subject in sorted(subject_sums)
+    ]
+
+    # Reduce, the windows and spectra of all subjects have the same shape
+    (
+        eeg_windows,
+        eeg_psds,
+        meg_windows,
+        meg_psds,
+        _,
+        _,
+        eeg_spectrograms,
+        meg_spectrograms,
+    ) = zip(*subject_windows)
+    return (
+        {
+            group_name: numpy.mean([windows[group_name] for windows in eeg_windows], axis=0)
+            for group_name in eeg_windows[0].keys()
+        },
+        {
+            group_name: (
+                eeg_psds[0][group_name][0],
+                numpy.mean([psds[group_name][1] for psds in eeg_psds], axis=0),
+            )
+            for group_name in eeg_psds[0].keys()
+        },
+        {
+            group_name: numpy.mean([windows[group_name] for windows in meg_windows], axis=0)
+            for group_name in meg_windows[0].keys()
+        },
+        {
+            group_name: (
+                meg_psds[0][group_name][0],
+                numpy.mean([psds[group_name][1] for psds in meg_psds], axis=0),
+            )
+            for group_name in meg_psds[0].keys()
+        },
+        subjects_errors(eeg_windows),
+        subjects_errors(meg_windows),
+        subjects_spectrograms(eeg_spectrograms),
+        subjects_spectrograms(meg_spectrograms),
+    )
+
+
+def subjects_errors(subject_windows):
+    """
+    Returns the standard error of the mean over the subjects' average windows per group
+    """
+    return {
+        group_name: (
+            numpy.std([windows[group_name] for windows in subject_windows], axis=0, ddof=1)
+            / math.sqrt(len(subject_windows))
+            if len(subject_windows) > 1
+            else numpy.zeros_like(subject_windows[0][group_name])
+        )
+        for group_name in subject_windows[0].keys()
+    }
+
+
+def subjects_spectrograms(subject_spectrograms):
+    """
+    Returns the mean power (in dB) over the subjects' spectrograms per group
+    """
+    return {
+        group_name: (
+            subject_spectrograms[0][group_name][0],
+            subject_spectrograms[0][group_name][1],
+            (
+                10
+                * numpy.log10(
+                    numpy.mean(
+                        [
+                            numpy.power(10, spectrograms[group_name][2] / 10)
+                            for spectrograms in subject_spectrograms
+                        ],
+                        axis=0,
+                    )
+                )
+            ).astype(numpy.float32),
+        )
+        for group_name in subject_spectrograms[0].keys()
+    }
@@ -1,6 +1,10 @@
+import numpy
 import plotly.graph_objects as go
 import data_access
 
+from functools import partial
+from scipy import spatial
+
 # Helper function to create a prettier mesh for the 3D MEG or EEG cap visualization.
 # plot_type is expected to be either "meg" or "eeg"
 def missing_mesh_idx(plot_type, el_names):
@@ -55,9 +59,8 @@ def missing_eeg_mesh_idx(el_names):
     ]
 
     # list of indices of the electrode signals in the original list of electrode names/coordinates
-    indices = []
-    for index, el_name in enumerate(els_to_connect):
-        indices.append(el_names.index(el_name))
+    el_positions = {el_name: index for index, el_name in enumerate(el_names)}
+    indices = [el_positions[el_name] for el_name in els_to_connect]
 
     # original coordinate indices that should be connected
     i = [
@@ -205,9 +208,8 @@ def missing_meg_mesh_idx(el_names):
     ]
 
     # list of indices of the electrode signals in the original list of electrode names/coordinates
-    indices = []
-    for index, el_name in enumerate(els_to_connect):
-        indices.append(el_names.index(el_name))
+    el_positions = {el_name: index for index, el_name in enumerate(el_names)}
+    indices = [el_positions[el_name] for el_name in els_to_connect]
 
     # original coordinate indices that should be connected
     i = [
@@ -250,6 +252,12 @@ def missing_meg_mesh_idx(el_names):
     return i, j, k
 
 
+# triangulate a cap mesh when the metadata does not include its faces,
+# this is the Delaunay triangulation of the positions projected on the x-y plane, as Plotly computes in the browser
+def triangulate_mesh(mesh_coords):
+    return spatial.Delaunay(numpy.array(mesh_coords[:2]).T).simplices.T.tolist()
+
+
 # helper function to get selection-specific attributes,
 # i.e., the electrode plot attributes used to distinguish selected markers from unselected markers
 def get_marker_values(selected):
@@ -262,7 +270,35 @@ def get_marker_values(selected):
 
 # generate a 3D visualization of an EEG or MEG "electrode cap"
 # plot_type is expected be either "eeg" or "meg" and is used to fill up "gaps" in the mesh
-def electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, group_toggles=None):
+# mesh_faces are the triangles of the mesh from the metadata (computed here if not given)
+# the figure is built once per cap_key (shared by all sessions of the server process) and copied afterwards,
+# the MEG cap is the same for every subject while the EEG cap differs per subject
+def electrode_plot(
+    el_names,
+    el_types,
+    el_coords,
+    mesh_coords,
+    plot_type,
+    group_toggles=None,
+    mesh_faces=None,
+    cap_key=None,
+):
+    create = partial(base_electrode_plot, el_names, el_types, el_coords, mesh_coords, plot_type, mesh_faces)
+    if cap_key is None:
+        base = create()
+    else:
+        base = data_access.cached(("electrode plot", cap_key), create)
+
+    # copy, so updates to a session's figure do not change the cached one
+    fig = go.Figure(base)
+    if group_toggles is not None:
+        update_electrode_plot(fig, group_toggles)
+
+    return fig
+
+
+# generate the 3D visualization of an EEG or MEG "electrode cap" with all groups unselected
+def base_electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, faces=None):
 
     # get the unique group names
     group_names = list(set(el_types))
@@ -292,7 +328,7 @@ def electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, group_
         trace_names = [el_names[i] for i in electrode_indices[group_name]]
         trace_colors = [data_access.group_colors[el_types[i]] for i in electrode_indices[group_name]]
 
-        marker_values = get_marker_values(group_toggles is not None and group_name in group_toggles and group_toggles[group_name])
+        marker_values = get_marker_values(False)
 
         electrode_traces[group_name] = go.Scatter3d(
             name=group_name, # set the group name, so we can easily select on this name for modifying specific traces
@@ -311,6 +347,12 @@ def electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, group_
             ),
         )
 
+    # triangles of the mesh, with the missing Mesh connections for a prettier mesh
+    # (given explicitly, so the browser does not triangulate the mesh)
+    if faces is None:
+        faces = triangulate_mesh(mesh_coords)
+    missing_i, missing_j, missing_k = missing_mesh_idx(plot_type, el_names)
+
     # trace for the mesh
     trace_mesh = go.Mesh3d(
         hoverinfo="skip",
@@ -319,25 +361,13 @@ def electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, group_
         x=mesh_x,
         y=mesh_y,
         z=mesh_z,
-    )
-
-    # add missing Mesh connections for a prettier mesh
-    missing_i, missing_j, missing_k = missing_mesh_idx(plot_type, el_names)
-    trace_missing_mesh = go.Mesh3d(
-        hoverinfo="skip",
-        opacity=1,
-        color="#C0C0C0",
-        type="mesh3d",
-        x=mesh_x,
-        y=mesh_y,
-        z=mesh_z,
-        i=missing_i,
-        j=missing_j,
-        k=missing_k,
+        i=numpy.concatenate([faces[0], missing_i]),
+        j=numpy.concatenate([faces[1], missing_j]),
+        k=numpy.concatenate([faces[2], missing_k]),
     )
 
     # include all traces
-    data = [trace_mesh, trace_missing_mesh]
+    data = [trace_mesh]
     data.extend(electrode_traces.values())
 
     # don't include any grids, axes, etc. (since we just want the 3D figure)
@@ -390,37 +420,27 @@ def electrode_plot(el_names, el_types, el_coords, mesh_coords, plot_type, group_
 # update fig, which is the 3D visualization of an EEG or MEG "electrode cap"
 # group_toggles is a dictionary containing group names as key and as value True if that group should be selected
 # and False if not
+# the figure is restyled in place, so a Panel pane showing it only sends the changed marker properties
+# of the affected traces instead of the whole figure
 def update_electrode_plot(fig, group_toggles):
 
-    # get the attributes that should be updated to distinguish between selected and unselected markers
-    selected_markers = get_marker_values(True)
-    unselected_markers = get_marker_values(False)
+    # indices of the traces per group name
+    trace_indices = {trace.name: idx for idx, trace in enumerate(fig.data)}
 
-    # update all traces with the same name as the group name in group_toggles
+    # restyle the trace with the same name as each group name in group_toggles,
+    # so it looks selected if the group_toggle has value True and unselected otherwise
     for group_name, group_toggle in group_toggles.items():
-        # if the group_toggle has value True, we should update the trace, so it looks selected
-        if group_toggle:
-            fig.update_traces(
-                marker=dict(
-                    size=selected_markers["size"],
-                    opacity=selected_markers["opacity"],
-                    line=dict(
-                        color=selected_markers["line_color"]
-                    )
-                ),
-                selector=dict(name=group_name)
-            )
-        else:
-            # if the group_toggle has value False, we should update the trace, so it looks unselected
-            fig.update_traces(
-                marker=dict(
-                    size=unselected_markers["size"],
-                    opacity=unselected_markers["opacity"],
-                    line=dict(
-                        color=unselected_markers["line_color"]
-                    )
-                ),
-                selector=dict(name=group_name)
-            )
-
-    return fig
\ No newline at end of file
+        if group_name not in trace_indices:
+            continue
+
+        marker_values = get_marker_values(group_toggle)
+        fig.plotly_restyle(
+            {
+                "marker.size": marker_values["size"],
+                "marker.opacity": marker_values["opacity"],
+                "marker.line.color": marker_values["line_color"],
+            },
+            trace_indexes=[trace_indices[group_name]],
+        )
+
+    return fig
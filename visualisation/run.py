@@ -1,11 +1,11 @@
-from turtle import update
+import asyncio
 import panel
 import logging
 import enum
 
 from functools import partial
 
-from bokehplots import avg_plots, window_plots, psd_plots
+from bokehplots import avg_plots, window_plots, psd_plots, spectrogram_plots
 from plotlyplots import electrode_plot, update_electrode_plot
 import data_access
 
@@ -19,21 +19,11 @@ logger.setLevel(logging.DEBUG)
 # ----
 # Metadata
 # ----
-metadata = data_access.parse_metadata()
+metadata = data_access.load_metadata()
 min_age = min([int(subject["age"]) for subject in metadata["subjects"]])
 max_age = max([int(subject["age"]) for subject in metadata["subjects"]])
-EEG_groups_assignment = {}
-for EEG_channel, EEG_type in zip(metadata["eeg_names"], metadata["eeg_types"]):
-    current = (
-        EEG_groups_assignment[EEG_type] if EEG_type in EEG_groups_assignment else []
-    )
-    EEG_groups_assignment[EEG_type] = current + [EEG_channel]
-MEG_groups_assignment = {}
-for MEG_channel, MEG_type in zip(metadata["meg_names"], metadata["meg_types"]):
-    current = (
-        MEG_groups_assignment[MEG_type] if MEG_type in MEG_groups_assignment else []
-    )
-    MEG_groups_assignment[MEG_type] = current + [MEG_channel]
+EEG_groups = metadata["eeg_groups"]
+MEG_groups = metadata["meg_groups"]
 
 
 def sex_to_string(sex):
@@ -183,6 +173,8 @@ def first_page(event):
     global topbar
     global grid
 
+    cancel_subject_data()
+
     grid.objects = {}
     new_grid = panel.GridSpec(sizing_mode="stretch_both")
 
@@ -302,6 +294,7 @@ class ViewMode(enum.Enum):
 class DataMode(enum.Enum):
     TIME = 1
     FREQUENCY = 2
+    SPECTROGRAM = 3
 
 
 current_view_mode = ViewMode.TOTAL
@@ -309,50 +302,628 @@ current_data_mode = DataMode.TIME
 
 
 # Data
-runs = []
-downsampled_runs = []
-EEG_group_avgs = None
-EEG_group_psds = None
-MEG_group_avgs = None
-MEG_group_psds = None
-downsampled_events = None
+current_subject = None
+load_task = None
+run_tasks = {}
+spectrogram_tasks = {}
+band_tasks = {}
+window_task = None
+induced_task = None
+grand_task = None
+EEG_group_levels = [None] * 6
+EEG_group_psds = [None] * 6
+MEG_group_levels = [None] * 6
+MEG_group_psds = [None] * 6
+EEG_group_spectrograms = [None] * 6
+MEG_group_spectrograms = [None] * 6
+EEG_group_bands = [None] * 6
+MEG_group_bands = [None] * 6
+run_events = [None] * 6
+subject_window_sums = None
 EEG_window_group_avgs = None
 EEG_window_group_psds = None
 MEG_window_group_avgs = None
 MEG_window_group_psds = None
+EEG_window_group_errors = None
+MEG_window_group_errors = None
+EEG_window_group_spectrograms = None
+MEG_window_group_spectrograms = None
+window_epoch_psds = None
+
+# Plots of the session per kind, reused for every run and mode (see reuse_plots)
+session_plots = {}
+
+
+def cancel_subject_data():
+    global load_task
+    global window_task
+    global subject_window_sums
+
+    # Stop loading the previous subject
+    for task in [
+        load_task,
+        window_task,
+        grand_task,
+        *run_tasks.values(),
+        *spectrogram_tasks.values(),
+        *band_tasks.values(),
+    ]:
+        if task is not None:
+            task.cancel()
+    load_task = None
+    window_task = None
+    run_tasks.clear()
+    spectrogram_tasks.clear()
+    band_tasks.clear()
 
+    # Clear previous
+    for data in [
+        EEG_group_levels,
+        EEG_group_psds,
+        MEG_group_levels,
+        MEG_group_psds,
+        EEG_group_spectrograms,
+        MEG_group_spectrograms,
+        EEG_group_bands,
+        MEG_group_bands,
+        run_events,
+    ]:
+        data[:] = [None] * 6
+    subject_window_sums = None
+    reset_windows(0)
+
+
+async def load_run_data(subject, run_idx):
+    """
+    Loads a run of a subject in the background,
+    the run is shown as soon as its data is ready if it is the selected run
+    """
+    loop = asyncio.get_running_loop()
+
+    # The run's data is only read if its results are not cached yet
+    read_data = data_access.run_reader(subject, run_idx + 1, EEG_groups, MEG_groups)
+
+    # Time domain first, drawn from the pyramid levels of the group averages
+    EEG_avgs, MEG_avgs, run_events[run_idx] = await loop.run_in_executor(
+        data_access.executor,
+        data_access.load_time_domain,
+        subject,
+        run_idx + 1,
+        EEG_groups,
+        MEG_groups,
+        read_data,
+    )
+    EEG_group_levels[run_idx], MEG_group_levels[run_idx] = await loop.run_in_executor(
+        data_access.executor,
+        data_access.load_levels,
+        subject,
+        run_idx + 1,
+        EEG_groups,
+        MEG_groups,
+        EEG_avgs,
+        MEG_avgs,
+    )
+    show_loaded_run(run_idx)
+
+    # PSDs
+    EEG_group_psds[run_idx], MEG_group_psds[run_idx] = await loop.run_in_executor(
+        data_access.executor,
+        data_access.load_frequency_domain,
+        subject,
+        run_idx + 1,
+        EEG_groups,
+        MEG_groups,
+        read_data,
+    )
+    show_loaded_run(run_idx)
 
-def get_subject_data():
-    global runs
-    global downsampled_runs
-    global EEG_group_avgs
-    global EEG_group_psds
-    global MEG_group_avgs
-    global MEG_group_psds
-    global downsampled_events
 
-    # Clear previous
-    runs = []
-    downsampled_runs = []
+def task_failed(task, forget):
+    """
+    Handles a background task that raised: logs the exception,
+    forgets the task (so it is started again when it is requested again) and stops loading the plots
+    """
+    if task.cancelled() or task.exception() is None:
+        return
 
-    # Runs
-    for i in range(1, 7):
-        run, downsampled_run = data_access.parse_run(subject_select.value, i)
-        runs.append(run)
-        downsampled_runs.append(downsampled_run)
+    logger.error("Loading failed", exc_info=task.exception())
+    forget()
+    EEG_pane.loading = False
+    MEG_pane.loading = False
 
-    # Averages
-    (
-        EEG_group_avgs,
-        EEG_group_psds,
-        MEG_group_avgs,
-        MEG_group_psds,
-        downsampled_events,
-    ) = data_access.group_averages(
-        downsampled_runs, EEG_groups_assignment, MEG_groups_assignment
+
+def forget_run(run_idx, task):
+    if run_tasks.get(run_idx) is task:
+        del run_tasks[run_idx]
+
+
+def request_run(run_idx):
+    """
+    Starts loading a run of the current subject, unless it is loading or loaded already
+    """
+    if run_idx not in run_tasks:
+        task = asyncio.ensure_future(load_run_data(current_subject, run_idx))
+        task.add_done_callback(
+            lambda task: task_failed(task, partial(forget_run, run_idx, task))
+        )
+        run_tasks[run_idx] = task
+    return run_tasks[run_idx]
+
+
+async def load_run_part(subject, run_idx, load, EEG_parts, MEG_parts):
+    """
+    Loads a part of a run of a subject in the background that only some modes show (e.g. its spectrograms),
+    the run is shown as soon as the part is ready if it is the selected run
+    """
+    loop = asyncio.get_running_loop()
+
+    # The run's data is only read if the part is not cached yet
+    read_data = data_access.run_reader(subject, run_idx + 1, EEG_groups, MEG_groups)
+
+    EEG_parts[run_idx], MEG_parts[run_idx] = await loop.run_in_executor(
+        data_access.executor,
+        load,
+        subject,
+        run_idx + 1,
+        EEG_groups,
+        MEG_groups,
+        read_data,
+    )
+    show_loaded_run(run_idx)
+
+
+def forget_run_part(tasks, run_idx, task):
+    if tasks.get(run_idx) is task:
+        del tasks[run_idx]
+
+
+def request_run_part(tasks, load, EEG_parts, MEG_parts, run_idx):
+    """
+    Starts loading a part of a run of the current subject on its first use (see load_run_part),
+    unless it is loading or loaded already
+    """
+    if run_idx not in tasks:
+        task = asyncio.ensure_future(
+            load_run_part(current_subject, run_idx, load, EEG_parts, MEG_parts)
+        )
+        task.add_done_callback(
+            lambda task: task_failed(
+                task, partial(forget_run_part, tasks, run_idx, task)
+            )
+        )
+        tasks[run_idx] = task
+    return tasks[run_idx]
+
+
+async def load_window_data(subject):
+    """
+    Loads the window sums of a subject in the background (these epoch the full resolution runs),
+    the windows are shown as soon as they are ready if they are being waited for
+    """
+    global subject_window_sums
+    loop = asyncio.get_running_loop()
+
+    subject_window_sums = await loop.run_in_executor(
+        data_access.executor, data_access.load_window_sums, subject
+    )
+    show_loaded_windows()
+
+
+def request_windows():
+    """
+    Starts loading the window sums of the current subject, unless they are loading or loaded already
+    """
+    global window_task
+    if window_task is None:
+        window_task = asyncio.ensure_future(load_window_data(current_subject))
+        window_task.add_done_callback(
+            lambda task: task_failed(task, partial(forget_windows, task))
+        )
+    return window_task
+
+
+def forget_windows(task):
+    global window_task
+    if window_task is task:
+        window_task = None
+
+
+async def load_induced_data(subject, event_selection, tmin, tmax):
+    """
+    Computes the spectra of the single epochs of a window of a subject in the background
+    (these epoch the runs again), only once they are asked for
+    """
+    global window_epoch_psds
+    loop = asyncio.get_running_loop()
+
+    window_epoch_psds = await loop.run_in_executor(
+        data_access.executor,
+        data_access.load_epoch_psds,
+        subject,
+        event_selection,
+        tmin,
+        tmax,
+    )
+    show_loaded_windows()
+
+
+def request_induced():
+    """
+    Starts computing the spectra of the single epochs of the current window, unless they are being computed already
+    """
+    global induced_task
+    if induced_task is None:
+        induced_task = asyncio.ensure_future(
+            load_induced_data(
+                current_subject,
+                selected_events(),
+                tmin_slider.value,
+                tplus_slider.value,
+            )
+        )
+        induced_task.add_done_callback(
+            lambda task: task_failed(task, partial(forget_induced, task))
+        )
+    return induced_task
+
+
+def forget_induced(task):
+    global induced_task
+    if induced_task is task:
+        induced_task = None
+
+
+async def load_subject_data():
+    """
+    Loads the selected run of the current subject first,
+    then prefetches the other runs and the window sums in the background
+    (a run that fails does not stop the others, see task_failed)
+    """
+    await asyncio.wait([request_run(run_select.value)])
+    for run_idx in range(6):
+        await asyncio.wait([request_run(run_idx)])
+    await asyncio.wait([request_windows()])
+
+
+def show_loaded_run(run_idx):
+    if (
+        EEG_pane.loading
+        and current_view_mode == ViewMode.TOTAL
+        and run_select.value == run_idx
+    ):
+        change_run(0)
+
+
+def show_loaded_windows():
+    if EEG_pane.loading and current_view_mode == ViewMode.WINDOW:
+        show_plots(windowed_plots())
+
+
+def total_plots(run_idx):
+    """
+    Creates the plots of a whole run for the current data mode,
+    None while the data of the run is still being loaded
+    """
+    if current_data_mode == DataMode.TIME:
+        if EEG_group_levels[run_idx] is None:
+            return None
+
+        # The envelopes of the frequency bands are only computed once a band is selected,
+        # they are shown from their own pyramid levels (the envelopes are its first level)
+        if band_select.value in data_access.frequency_bands:
+            if EEG_group_bands[run_idx] is None:
+                request_run_part(
+                    band_tasks,
+                    data_access.load_band_envelopes,
+                    EEG_group_bands,
+                    MEG_group_bands,
+                    run_idx,
+                )
+                return None
+            EEG_band_levels, MEG_band_levels = data_access.load_band_levels(
+                current_subject,
+                run_idx + 1,
+                band_select.value,
+                EEG_groups,
+                MEG_groups,
+                EEG_group_bands[run_idx][band_select.value],
+                MEG_group_bands[run_idx][band_select.value],
+            )
+            return reuse_plots(
+                avg_plots,
+                EEG_band_levels,
+                EEG_group_visible(),
+                MEG_band_levels,
+                MEG_group_visible(),
+                run_events[run_idx],
+            )
+
+        return reuse_plots(
+            avg_plots,
+            EEG_group_levels[run_idx],
+            EEG_group_visible(),
+            MEG_group_levels[run_idx],
+            MEG_group_visible(),
+            run_events[run_idx],
+        )
+
+    # Spectrograms are only computed once the mode is opened, the cache keeps later openings instant
+    if current_data_mode == DataMode.SPECTROGRAM:
+        if EEG_group_spectrograms[run_idx] is None:
+            request_run_part(
+                spectrogram_tasks,
+                data_access.load_spectrogram,
+                EEG_group_spectrograms,
+                MEG_group_spectrograms,
+                run_idx,
+            )
+            return None
+        return reuse_plots(
+            spectrogram_plots,
+            EEG_group_spectrograms[run_idx],
+            EEG_group_visible(),
+            MEG_group_spectrograms[run_idx],
+            MEG_group_visible(),
+            None,
+        )
+
+    if EEG_group_psds[run_idx] is None:
+        return None
+    return reuse_plots(
+        psd_plots,
+        EEG_group_psds[run_idx],
+        EEG_group_visible(),
+        MEG_group_psds[run_idx],
+        MEG_group_visible(),
     )
 
 
+def windowed_plots():
+    """
+    Creates the plots of the windows around the selected events for the current data mode,
+    None while the window sums of the subject are still being loaded
+    """
+    global EEG_window_group_avgs
+    global EEG_window_group_psds
+    global MEG_window_group_avgs
+    global MEG_window_group_psds
+    global EEG_window_group_errors
+    global MEG_window_group_errors
+    global EEG_window_group_spectrograms
+    global MEG_window_group_spectrograms
+
+    # The grand average is computed in the background, across the subjects
+    if grand_button.value:
+        if EEG_window_group_avgs is None:
+            request_grand_average()
+            return None
+
+    # The full resolution runs are only needed from here on
+    elif subject_window_sums is None:
+        request_windows()
+        return None
+
+    # The spectra of the epochs are only computed once they are asked for
+    elif (
+        induced_button.value
+        and EEG_window_group_avgs is None
+        and window_epoch_psds is None
+    ):
+        request_induced()
+        return None
+
+    # Re-calculate windows if needed
+    elif EEG_window_group_avgs is None:
+        (
+            EEG_window_group_avgs,
+            EEG_window_group_psds,
+            MEG_window_group_avgs,
+            MEG_window_group_psds,
+            EEG_window_group_errors,
+            MEG_window_group_errors,
+            EEG_window_group_spectrograms,
+            MEG_window_group_spectrograms,
+        ) = data_access.load_windows(
+            current_subject,
+            subject_window_sums,
+            selected_events(),
+            tmin_slider.value,
+            tplus_slider.value,
+            EEG_groups,
+            MEG_groups,
+            window_epoch_psds if induced_button.value else None,
+        )
+
+    if current_data_mode == DataMode.TIME:
+        return reuse_plots(
+            window_plots,
+            EEG_window_group_avgs,
+            EEG_window_group_errors,
+            EEG_group_visible(),
+            MEG_window_group_avgs,
+            MEG_window_group_errors,
+            MEG_group_visible(),
+            tmin_slider.value,
+            tplus_slider.value,
+        )
+
+    if current_data_mode == DataMode.SPECTROGRAM:
+        return reuse_plots(
+            spectrogram_plots,
+            EEG_window_group_spectrograms,
+            EEG_group_visible(),
+            MEG_window_group_spectrograms,
+            MEG_group_visible(),
+            -tmin_slider.value,
+        )
+
+    return reuse_plots(
+        psd_plots,
+        EEG_window_group_psds,
+        EEG_group_visible(),
+        MEG_window_group_psds,
+        MEG_group_visible(),
+    )
+
+
+def selected_events():
+    return [
+        idx + 1
+        for idx, value in enumerate([toggle.value for toggle in event_toggles])
+        if value
+    ]
+
+
+async def await_futures(futures):
+    """
+    Awaits a dict of futures of other threads or processes without holding a thread of the executor,
+    shielded since they are shared with other sessions (cancelling this task must not cancel them)
+    """
+    return {
+        key: await asyncio.shield(asyncio.wrap_future(future))
+        for key, future in futures.items()
+    }
+
+
+async def load_grand_average(subjects):
+    """
+    Computes the grand average windows of the given subjects in the background,
+    only the subjects that were never loaded are windowed again (in worker processes),
+    their window sums are awaited without holding a thread of the executor
+    """
+    global EEG_window_group_avgs
+    global EEG_window_group_psds
+    global MEG_window_group_avgs
+    global MEG_window_group_psds
+    global EEG_window_group_errors
+    global MEG_window_group_errors
+    global EEG_window_group_spectrograms
+    global MEG_window_group_spectrograms
+    loop = asyncio.get_running_loop()
+
+    event_selection = selected_events()
+    tmin = tmin_slider.value
+    tmax = tplus_slider.value
+    induced = induced_button.value
+    key = (
+        "grand average",
+        tuple(subjects),
+        tuple(event_selection),
+        tmin,
+        tmax,
+        EEG_groups["key"],
+        MEG_groups["key"],
+        induced,
+    )
+
+    windows = data_access.cache_get(key)
+    if windows is None:
+        window_futures = data_access.subjects_sums(
+            subjects, "window sums", data_access.load_window_sums
+        )
+        induced_futures = (
+            data_access.subjects_sums(
+                subjects,
+                ("epoch psds", tuple(event_selection), tmin, tmax),
+                partial(
+                    data_access.load_epoch_psds,
+                    event_selection=event_selection,
+                    tmin=tmin,
+                    tmax=tmax,
+                ),
+            )
+            if induced
+            else None
+        )
+        subject_sums = await await_futures(window_futures)
+        subject_epoch_psds = (
+            await await_futures(induced_futures) if induced else None
+        )
+
+        windows = await loop.run_in_executor(
+            data_access.executor,
+            data_access.cached,
+            key,
+            partial(
+                data_access.grand_average,
+                subject_sums,
+                event_selection,
+                tmin,
+                tmax,
+                EEG_groups,
+                MEG_groups,
+                subject_epoch_psds,
+            ),
+        )
+    (
+        EEG_window_group_avgs,
+        EEG_window_group_psds,
+        MEG_window_group_avgs,
+        MEG_window_group_psds,
+        EEG_window_group_errors,
+        MEG_window_group_errors,
+        EEG_window_group_spectrograms,
+        MEG_window_group_spectrograms,
+    ) = windows
+    show_loaded_windows()
+
+
+def forget_grand_average(task):
+    global grand_task
+    if grand_task is task:
+        grand_task = None
+
+
+def request_grand_average():
+    """
+    Starts computing the grand average of the subjects matching the filters of the first page,
+    unless it is being computed already
+    """
+    global grand_task
+    if grand_task is None:
+        task = asyncio.ensure_future(
+            load_grand_average(list(subject_select.options.values()))
+        )
+        task.add_done_callback(
+            lambda task: task_failed(task, partial(forget_grand_average, task))
+        )
+        grand_task = task
+    return grand_task
+
+
+def reuse_plots(create, *args):
+    """
+    Shows data in the session's plots of a kind (avg_plots, window_plots, psd_plots or spectrogram_plots),
+    the plots are created the first time and updated in place afterwards so only changed data is sent
+    """
+    if create not in session_plots:
+        session_plots[create] = create(*args, logger)
+    else:
+        session_plots[create][4](*args)
+
+    return session_plots[create][:4]
+
+
+def show_plots(plots):
+    global EEG_lines
+    global MEG_lines
+
+    # Keep loading until the data is there
+    if plots is None:
+        return
+
+    # Only swap figures when the kind of plots changes
+    new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = plots
+    if EEG_pane.object is not new_EEG_p:
+        EEG_pane.object = new_EEG_p
+    if MEG_pane.object is not new_MEG_p:
+        MEG_pane.object = new_MEG_p
+
+    # Stop loading
+    EEG_pane.loading = False
+    MEG_pane.loading = False
+
+
 # Run select
 run_select = panel.widgets.Select(
     options={"Run " + str(i): i - 1 for i in range(1, 7)}, value=0, align="center", style={"font-family":"arial"}
@@ -360,11 +931,6 @@ run_select = panel.widgets.Select(
 
 
 def change_run(event):
-    global current_data_mode
-    global EEG_pane
-    global EEG_lines
-    global MEG_pane
-    global MEG_lines
     run_idx = run_select.value
 
     if current_data_mode is not None:
@@ -373,50 +939,44 @@ def change_run(event):
         EEG_pane.loading = True
         MEG_pane.loading = True
 
-        if current_data_mode == DataMode.TIME:
-            new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = avg_plots(
-                EEG_group_avgs[run_idx],
-                EEG_group_visible(),
-                MEG_group_avgs[run_idx],
-                MEG_group_visible(),
-                downsampled_events[run_idx],
-                logger,
-            )
-        else:
-            new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = psd_plots(
-                EEG_group_psds[run_idx],
-                EEG_group_visible(),
-                MEG_group_psds[run_idx],
-                MEG_group_visible(),
-                logger,
-            )
-
-        EEG_pane.object = new_EEG_p
-        MEG_pane.object = new_MEG_p
-
-        # Stop loading
-        EEG_pane.loading = False
-        MEG_pane.loading = False
+        request_run(run_idx)
+        show_plots(total_plots(run_idx))
 
 
 run_select.param.watch(change_run, ["value"], onlychanged=True)
 
+# Band select, shows the amplitude envelopes of a frequency band instead of the signal
+band_select = panel.widgets.Select(
+    options={
+        "Signal": "Signal",
+        **{
+            f"{band} amplitude ({low}-{high} Hz)": band
+            for band, (low, high) in data_access.frequency_bands.items()
+        },
+    },
+    value="Signal",
+    align="center",
+    style={"font-family":"arial"}
+)
+band_select.param.watch(change_run, ["value"], onlychanged=True)
+
 
-# PSD toggle
-psd_button = panel.widgets.Toggle(
-    name="PSD", align="center", sizing_mode="stretch_width", style={"font-family":"arial"}
+# Data mode select (time, PSD or spectrogram)
+data_select = panel.widgets.RadioButtonGroup(
+    options={
+        "Time": DataMode.TIME,
+        "PSD": DataMode.FREQUENCY,
+        "Spectrogram": DataMode.SPECTROGRAM,
+    },
+    value=DataMode.TIME,
+    align="center",
+    sizing_mode="stretch_width",
+    style={"font-family":"arial"}
 )
 
 
 def change_data(event):
     global current_data_mode
-    global current_view_mode
-    global EEG_lines
-    global MEG_lines
-    global EEG_window_group_avgs
-    global EEG_window_group_psds
-    global MEG_window_group_avgs
-    global MEG_window_group_psds
     run_idx = run_select.value
 
     if current_data_mode is not None:
@@ -425,66 +985,33 @@ def change_data(event):
         EEG_pane.loading = True
         MEG_pane.loading = True
 
+        current_data_mode = data_select.value
         if current_data_mode == DataMode.TIME:
-            current_data_mode = DataMode.FREQUENCY
-
-            if current_view_mode == ViewMode.TOTAL:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = psd_plots(
-                    EEG_group_psds[run_idx],
-                    EEG_group_visible(),
-                    MEG_group_psds[run_idx],
-                    MEG_group_visible(),
-                    logger,
-                )
-                avg_button.disabled = True
-                tmin_slider.disabled = True
-                tplus_slider.disabled = True
-                for toggle in event_toggles:
-                    toggle.disabled = True
-            else:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = psd_plots(
-                    EEG_window_group_psds,
-                    EEG_group_visible(),
-                    MEG_window_group_psds,
-                    MEG_group_visible(),
-                    logger,
-                )
-        else:
-            current_data_mode = DataMode.TIME
             enable_avg(0)
-            if current_view_mode == ViewMode.TOTAL:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = avg_plots(
-                    EEG_group_avgs[run_idx],
-                    EEG_group_visible(),
-                    MEG_group_avgs[run_idx],
-                    MEG_group_visible(),
-                    downsampled_events[run_idx],
-                    logger,
-                )
+
+        # Windows can only be selected in the time domain
+        if current_view_mode == ViewMode.TOTAL:
+            plots = total_plots(run_idx)
+            if current_data_mode == DataMode.TIME:
+                band_select.disabled = False
                 tmin_slider.disabled = False
                 tplus_slider.disabled = False
-                for toggle in event_toggles:
+                for toggle in event_toggles + [grand_button, induced_button]:
                     toggle.disabled = False
             else:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = window_plots(
-                    EEG_window_group_avgs,
-                    EEG_group_visible(),
-                    MEG_window_group_avgs,
-                    MEG_group_visible(),
-                    tmin_slider.value,
-                    tplus_slider.value,
-                    logger,
-                )
-
-        EEG_pane.object = new_EEG_p
-        MEG_pane.object = new_MEG_p
+                band_select.disabled = True
+                avg_button.disabled = True
+                tmin_slider.disabled = True
+                tplus_slider.disabled = True
+                for toggle in event_toggles + [grand_button, induced_button]:
+                    toggle.disabled = True
+        else:
+            plots = windowed_plots()
 
-        # Stop loading
-        EEG_pane.loading = False
-        MEG_pane.loading = False
+        show_plots(plots)
 
 
-psd_button.param.watch(change_data, ["value"], onlychanged=True)
+data_select.param.watch(change_data, ["value"], onlychanged=True)
 
 
 # AVG toggle
@@ -502,15 +1029,6 @@ avg_button = panel.widgets.Toggle(
 
 def change_view(event):
     global current_view_mode
-    global current_data_mode
-    global EEG_lines
-    global MEG_lines
-    global EEG_head
-    global MEG_head
-    global EEG_window_group_avgs
-    global EEG_window_group_psds
-    global MEG_window_group_avgs
-    global MEG_window_group_psds
     run_idx = run_select.value
 
     if current_data_mode is not None:
@@ -519,86 +1037,28 @@ def change_view(event):
         EEG_pane.loading = True
         MEG_pane.loading = True
 
-        # Event selection
-        selected_events = [
-            idx + 1
-            for idx, value in enumerate([toggle.value for toggle in event_toggles])
-            if value
-        ]
-
-        # Re-calculate windows if needed
-        if EEG_window_group_avgs is None:
-            (
-                EEG_window_group_avgs,
-                EEG_window_group_psds,
-                MEG_window_group_avgs,
-                MEG_window_group_psds,
-            ) = data_access.avg_windows(
-                runs,
-                selected_events,
-                tmin_slider.value,
-                tplus_slider.value,
-                EEG_groups_assignment,
-                MEG_groups_assignment,
-            )
-
         if current_view_mode == ViewMode.TOTAL:
             current_view_mode = ViewMode.WINDOW
-            if current_data_mode == DataMode.TIME:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = window_plots(
-                    EEG_window_group_avgs,
-                    EEG_group_visible(),
-                    MEG_window_group_avgs,
-                    MEG_group_visible(),
-                    tmin_slider.value,
-                    tplus_slider.value,
-                    logger,
-                )
-            else:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = psd_plots(
-                    EEG_window_group_psds,
-                    EEG_group_visible(),
-                    MEG_window_group_psds,
-                    MEG_group_visible(),
-                    logger,
-                )
+            plots = windowed_plots()
 
             run_select.disabled = True
+            band_select.disabled = True
             tmin_slider.disabled = True
             tplus_slider.disabled = True
-            for toggle in event_toggles:
+            for toggle in event_toggles + [grand_button, induced_button]:
                 toggle.disabled = True
         else:
             current_view_mode = ViewMode.TOTAL
+            plots = total_plots(run_idx)
             if current_data_mode == DataMode.TIME:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = avg_plots(
-                    EEG_group_avgs[run_idx],
-                    EEG_group_visible(),
-                    MEG_group_avgs[run_idx],
-                    MEG_group_visible(),
-                    downsampled_events[run_idx],
-                    logger,
-                )
+                band_select.disabled = False
                 tmin_slider.disabled = False
                 tplus_slider.disabled = False
-                for toggle in event_toggles:
+                for toggle in event_toggles + [grand_button, induced_button]:
                     toggle.disabled = False
-            else:
-                new_EEG_p, EEG_lines, new_MEG_p, MEG_lines = psd_plots(
-                    EEG_group_psds[run_idx],
-                    EEG_group_visible(),
-                    MEG_group_psds[run_idx],
-                    MEG_group_visible(),
-                    logger,
-                )
             run_select.disabled = False
 
-        EEG_pane.object = new_EEG_p
-        MEG_pane.object = new_MEG_p
-
-        # Stop loading
-        EEG_pane.loading = False
-        MEG_pane.loading = False
+        show_plots(plots)
 
 
 avg_button.param.watch(change_view, ["value"], onlychanged=True)
@@ -628,14 +1088,32 @@ tplus_slider = panel.widgets.FloatSlider(
 
 
 def reset_windows(event):
+    global grand_task
+    global induced_task
+    global window_epoch_psds
     global EEG_window_group_avgs
     global EEG_window_group_psds
     global MEG_window_group_avgs
     global MEG_window_group_psds
+    global EEG_window_group_errors
+    global MEG_window_group_errors
+    global EEG_window_group_spectrograms
+    global MEG_window_group_spectrograms
+    if grand_task is not None:
+        grand_task.cancel()
+    grand_task = None
+    if induced_task is not None:
+        induced_task.cancel()
+    induced_task = None
+    window_epoch_psds = None
     EEG_window_group_avgs = None
     EEG_window_group_psds = None
     MEG_window_group_avgs = None
     MEG_window_group_psds = None
+    EEG_window_group_errors = None
+    MEG_window_group_errors = None
+    EEG_window_group_spectrograms = None
+    MEG_window_group_spectrograms = None
 
 
 tmin_slider.param.watch(reset_windows, ["value"], onlychanged=True)
@@ -665,15 +1143,39 @@ for toggle in event_toggles:
     toggle.param.watch(enable_avg, ["value"], onlychanged=True)
     toggle.param.watch(reset_windows, ["value"], onlychanged=True)
 
+# Grand average toggle, windows all subjects matching the filters instead of the current one
+grand_button = panel.widgets.Toggle(
+    name="All subjects",
+    align="center",
+    width=100,
+    margin=(0, 2),
+    style={"font-family":"arial"}
+)
+grand_button.param.watch(reset_windows, ["value"], onlychanged=True)
+
+# Induced toggle, the window PSDs average the spectra of the epochs instead of being those of the average window
+induced_button = panel.widgets.Toggle(
+    name="Induced",
+    align="center",
+    width=100,
+    margin=(0, 2),
+    style={"font-family":"arial"}
+)
+induced_button.param.watch(reset_windows, ["value"], onlychanged=True)
+
+
 # Whole UI bar
 UI_bar = panel.Row(
     run_select,
-    psd_button,
+    band_select,
+    data_select,
     panel.layout.HSpacer(),
     avg_text,
     tmin_slider,
     tplus_slider,
     *event_toggles,
+    grand_button,
+    induced_button,
     avg_button,
 )
 
@@ -687,9 +1189,9 @@ def show_EEG_group(group_name, event):
         for line in EEG_lines[group_name]:
             line.visible = event.new
 
-    # Balls
+    # Balls, restyled in place so only the changed marker properties are sent
     if EEG_head is not None:
-        EEG_head_pane.objects[0].object = update_electrode_plot(EEG_head, {group_name: event.new})
+        update_electrode_plot(EEG_head, {group_name: event.new})
 
 
 def EEG_group_visible():
@@ -707,9 +1209,9 @@ def show_MEG_group(group_name, event):
         for line in MEG_lines[group_name]:
             line.visible = event.new
 
-    # Balls
+    # Balls, restyled in place so only the changed marker properties are sent
     if MEG_head is not None:
-        MEG_head_pane.objects[0].object = update_electrode_plot(MEG_head, {group_name: event.new})
+        update_electrode_plot(MEG_head, {group_name: event.new})
 
 
 def MEG_group_visible():
@@ -783,7 +1285,7 @@ for group_name, group_toggle in MEG_group_toggles:
     )
 
 
-def second_page(event):
+async def second_page(event):
     global EEG_pane
     global EEG_lines
     global EEG_head
@@ -794,15 +1296,14 @@ def second_page(event):
     global MEG_head_pane
     global current_data_mode
     global current_view_mode
+    global current_subject
+    global load_task
 
     # Clear first page
     grid.objects = {}
     grid[13:14, 7:10] = panel.Spacer()
     new_grid = panel.GridSpec(sizing_mode="stretch_both")
 
-    # Start loading animation
-    grid.loading = True
-
     # Add selected subject as subtitle
     topbar.pop(0)
     topbar.append(
@@ -820,14 +1321,19 @@ def second_page(event):
 
 
     # (Re)set state
+    cancel_subject_data()
     current_data_mode = None
-    psd_button.value = False
+    data_select.value = DataMode.TIME
     avg_button.value = False
     event_toggles[0].value = True
     event_toggles[0].disabled = False
     for toggle in event_toggles[1:]:
         toggle.value = False
         toggle.disabled = False
+    grand_button.value = False
+    grand_button.disabled = False
+    induced_button.value = False
+    induced_button.disabled = False
     for group_name, toggle in EEG_group_toggles + MEG_group_toggles:
         toggle.value = True
         toggle.disabled = False
@@ -837,6 +1343,8 @@ def second_page(event):
     tplus_slider.disabled = False
     run_select.value = 0
     run_select.disabled = False
+    band_select.value = "Signal"
+    band_select.disabled = False
     current_data_mode = DataMode.TIME
     current_view_mode = ViewMode.TOTAL
 
@@ -846,21 +1354,11 @@ def second_page(event):
     # Add second page UI bar
     new_grid[1, :11] = UI_bar
 
-    # Load data
-    get_subject_data()
-
-    # Create Bokeh plots
-    EEG_p, EEG_lines, MEG_p, MEG_lines = avg_plots(
-        EEG_group_avgs[0],
-        EEG_group_visible(),
-        MEG_group_avgs[0],
-        MEG_group_visible(),
-        downsampled_events[0],
-        logger,
-    )
-
-    # Set layout
-    EEG_pane = panel.pane.Bokeh(EEG_p, margin=(0, 0, 10, 0))
+    # Set layout, the Bokeh plots are added once their data is loaded
+    EEG_lines = None
+    MEG_lines = None
+    session_plots.clear()
+    EEG_pane = panel.pane.Bokeh(None, margin=(0, 0, 10, 0), loading=True)
     EEG_head = electrode_plot(
         metadata["eeg_names"],
         metadata["eeg_types"],
@@ -868,6 +1366,8 @@ def second_page(event):
         metadata["subjects"][subject_select.value - 1]["mesh_coords"],
         "eeg",
         EEG_group_visible(),
+        metadata["subjects"][subject_select.value - 1].get("mesh_faces"),
+        ("eeg", subject_select.value),
     )
     EEG_head_pane = panel.Row(
         panel.pane.Plotly(
@@ -878,7 +1378,7 @@ def second_page(event):
         align="center",
         margin=0,
     )
-    MEG_pane = panel.pane.Bokeh(MEG_p, margin=(0, 0, 10, 0))
+    MEG_pane = panel.pane.Bokeh(None, margin=(0, 0, 10, 0), loading=True)
     MEG_head = electrode_plot(
         metadata["meg_names"],
         metadata["meg_types"],
@@ -886,6 +1386,8 @@ def second_page(event):
         metadata["meg_mesh_coords"],
         "meg",
         MEG_group_visible(),
+        metadata.get("meg_mesh_faces"),
+        ("meg",),
     )
     MEG_head_pane = panel.Row(
         panel.pane.Plotly(
@@ -908,9 +1410,12 @@ def second_page(event):
     new_grid[8:14, 7] = MEG_group_toggles_col
     new_grid[8:14, 8:11] = MEG_head_pane
 
-    # Stop loading animation and swap grid contents
+    # Swap grid contents
     grid.objects = new_grid.objects
-    grid.loading = False
+
+    # Load data in the background
+    current_subject = subject_select.value
+    load_task = asyncio.ensure_future(load_subject_data())
 
 start_analysis_button.on_click(second_page)
 